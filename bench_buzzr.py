@@ -0,0 +1,272 @@
+import asyncio
+import websockets
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+import hashlib
+import geohash2
+from redis import asyncio as aioredis
+
+# Population centres the simulated devices cluster around, with a spread in degrees
+CITIES = [
+    ("Lagos", 6.5244, 3.3792, 0.08, 0.45),
+    ("Ibadan", 7.3775, 3.9470, 0.05, 0.15),
+    ("Abuja", 9.0765, 7.3986, 0.06, 0.15),
+    ("Benin City", 6.3350, 5.6037, 0.04, 0.10),
+    ("Kano", 12.0022, 8.5920, 0.05, 0.15),
+]
+
+DEVICE_WORKERS_KEY = "device_workers"
+INDEX_PRECISION = 7
+BROADCAST_PREFIX = "bench "
+
+
+def sha256_encode(string):
+    # Encode the string as bytes
+    encoded_string = string.encode('utf-8')
+    # Compute the SHA-256 hash
+    sha256_hash = hashlib.sha256(encoded_string).hexdigest()
+    return sha256_hash
+
+
+def encode_lat_lon(latitude, longitude, precision=8):
+    # Encode latitude and longitude as a geohash
+    geohash = geohash2.encode(latitude, longitude, precision=precision)
+    return geohash
+
+
+def random_location(rng):
+    # Pick a city by its share of devices, then scatter around its centre
+    _, lat, lon, spread, _ = rng.choices(CITIES, weights=[city[4] for city in CITIES])[0]
+    return rng.gauss(lat, spread), rng.gauss(lon, spread)
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    if not samples:
+        return {point: float('nan') for point in points}
+    ordered = sorted(samples)
+    return {point: ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))] for point in points}
+
+
+def process_rss_kb(pid):
+    # Resident memory of a process and all of its descendants, from /proc
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            with open(f"/proc/{current}/task/{current}/children") as children:
+                pending.extend(int(child) for child in children.read().split())
+        except FileNotFoundError:
+            continue
+    return total
+
+
+def raise_file_limit():
+    # Every simulated device holds a socket on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def start_relay(options):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "relay_server_buzzr6.py"),
+               "--port", str(options.port), "--insecure", "--metrics-port", str(options.metrics_port),
+               "--workers", str(options.workers), "--compute-workers", str(options.compute_workers),
+               "--redis-host", options.redis_host, "--redis-port", str(options.redis_port), "--redis-db", str(options.redis_db)]
+    log = open(options.relay_log, "w") if options.relay_log else subprocess.DEVNULL
+    return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_for_port(port, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"Relay did not open port {port} within {timeout}s")
+
+
+class Device:
+    def __init__(self, index, rng):
+        self.device_id = sha256_encode(f"bench-{index}")
+        self.geohash = encode_lat_lon(*random_location(rng))
+        self.websocket = None
+        self.latencies = []
+        self.reader = None
+
+    async def connect(self, url):
+        self.websocket = await websockets.connect(url, max_queue=None, ping_interval=None, close_timeout=1)
+        await self.websocket.send(json.dumps({"action": "register", "geohash": self.geohash, "device_id": self.device_id}))
+        self.reader = asyncio.create_task(self.read())
+
+    async def read(self):
+        # Broadcast text carries the wall clock time it was sent at
+        try:
+            async for raw in self.websocket:
+                data = json.loads(raw)
+                if data.get("action") != "broadcast":
+                    continue
+                _, _, text = data.get("message", "").partition(BROADCAST_PREFIX)
+                try:
+                    self.latencies.append(time.time() - float(text))
+                except ValueError:
+                    pass
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.reader is not None:
+            await self.reader
+
+
+async def bench_register(options, devices, redis_conn, relay):
+    url = f"ws://127.0.0.1:{options.port}"
+    semaphore = asyncio.Semaphore(options.connect_concurrency)
+
+    async def connect(device):
+        async with semaphore:
+            await device.connect(url)
+
+    rss_before = process_rss_kb(relay.pid)
+    start = time.perf_counter()
+    await asyncio.gather(*[connect(device) for device in devices])
+    connected = time.perf_counter() - start
+
+    # Registration is complete once the relay has recorded the owner of every device
+    deadline = time.monotonic() + options.settle_timeout
+    device_ids = [device.device_id for device in devices]
+    registered = 0
+    while time.monotonic() < deadline:
+        owners = await redis_conn.hmget(DEVICE_WORKERS_KEY, device_ids)
+        registered = sum(owner is not None for owner in owners)
+        if registered >= len(devices):
+            break
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - start
+    rss_after = process_rss_kb(relay.pid)
+
+    print(f"connect: {len(devices)} devices in {connected:.2f}s ({len(devices) / connected:.0f}/s)")
+    print(f"register: {registered} devices in {elapsed:.2f}s ({registered / elapsed:.0f}/s)")
+    print(f"memory: {rss_before / 1024:.1f} MiB idle, {rss_after / 1024:.1f} MiB connected, "
+          f"{(rss_after - rss_before) / len(devices):.1f} KiB per connection")
+
+
+async def bench_broadcast(options, devices, rng):
+    # Devices the relay has dropped are left out
+    devices = [device for device in devices if device.websocket.open]
+    senders = rng.sample(devices, min(options.broadcasts, len(devices)))
+    interval = 1 / options.broadcast_rate
+    start = time.perf_counter()
+    for device in senders:
+        await device.websocket.send(json.dumps({"action": "broadcast", "device_id": device.device_id,
+                                                "geohash": device.geohash, "message": f"{BROADCAST_PREFIX}{time.time()}"}))
+        await asyncio.sleep(interval)
+    await asyncio.sleep(options.drain_seconds)
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for device in devices for latency in device.latencies]
+    points = percentiles(latencies)
+    print(f"broadcast: {len(senders)} messages, {len(latencies)} deliveries in {elapsed:.2f}s "
+          f"({len(latencies) / max(len(senders), 1):.0f} per message)")
+    print("delivery latency: " + ", ".join(f"p{point} {value * 1000:.1f}ms" for point, value in points.items()))
+
+
+async def bench_location(options, devices, redis_conn, rng):
+    # Moves of about a kilometre so each update lands the device in a new cell
+    devices = [device for device in devices if device.websocket.open]
+    movers = rng.sample(devices, min(options.location_devices, len(devices)))
+    sent = 0
+    start = time.perf_counter()
+    for _ in range(options.location_rounds):
+        for device in movers:
+            lat, lon = geohash2.decode(device.geohash)
+            new_geohash = encode_lat_lon(float(lat) + rng.uniform(-0.01, 0.01), float(lon) + rng.uniform(-0.01, 0.01))
+            await device.websocket.send(json.dumps({"action": "update_location", "device_id": device.device_id,
+                                                    "old_geohash": device.geohash, "new_geohash": new_geohash}))
+            device.geohash = new_geohash
+            sent += 1
+    send_time = time.perf_counter() - start
+
+    # Updates are coalesced by the relay, so only the cell of the last location of each device has to land
+    sampled = rng.sample(movers, min(200, len(movers)))
+    deadline = time.monotonic() + options.settle_timeout
+    pending = sampled
+    while pending and time.monotonic() < deadline:
+        records = await redis_conn.mget([f"user:{device.device_id}" for device in pending])
+        pending = [device for device, record in zip(pending, records)
+                   if record is None or json.loads(record).get("cell") != device.geohash[:INDEX_PRECISION]]
+        if pending:
+            await asyncio.sleep(0.05)
+    applied = time.perf_counter() - start
+
+    print(f"location: {sent} updates sent in {send_time:.2f}s ({sent / send_time:.0f}/s), "
+          f"{len(sampled) - len(pending)}/{len(sampled)} sampled devices settled after {applied:.2f}s")
+
+
+async def run(options):
+    rng = random.Random(options.seed)
+    limit = raise_file_limit()
+    if limit < options.devices * 2 + 100:
+        print(f"Warning: open file limit {limit} is low for {options.devices} devices")
+
+    redis_conn = aioredis.Redis(host=options.redis_host, port=options.redis_port, db=options.redis_db)
+    if options.flush:
+        await redis_conn.flushdb()
+
+    relay = start_relay(options)
+    devices = [Device(index, rng) for index in range(options.devices)]
+    try:
+        await wait_for_port(options.port)
+        await bench_register(options, devices, redis_conn, relay)
+        await bench_broadcast(options, devices, rng)
+        await bench_location(options, devices, redis_conn, rng)
+    finally:
+        await asyncio.gather(*[device.close() for device in devices], return_exceptions=True)
+        relay.terminate()
+        try:
+            relay.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            relay.kill()
+        await redis_conn.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator and benchmark for the Buzzr relay")
+    parser.add_argument("--devices", type=int, default=10000, help="simulated devices, one connection each")
+    parser.add_argument("--port", type=int, default=7171, help="port to run the relay under test on")
+    parser.add_argument("--workers", type=int, default=1, help="relay worker processes")
+    parser.add_argument("--compute-workers", type=int, default=0, help="relay compute processes per worker")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="connections opened at once")
+    parser.add_argument("--broadcasts", type=int, default=50, help="broadcasts sent by randomly chosen devices")
+    parser.add_argument("--broadcast-rate", type=float, default=10, help="broadcasts per second")
+    parser.add_argument("--drain-seconds", type=float, default=5, help="time left for deliveries after the last broadcast")
+    parser.add_argument("--location-devices", type=int, default=2000, help="devices sending location updates")
+    parser.add_argument("--location-rounds", type=int, default=5, help="updates sent by each moving device")
+    parser.add_argument("--settle-timeout", type=float, default=60, help="seconds to wait for the relay to catch up")
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--redis-db", type=int, default=15, help="Redis database for the relay under test; 0 is the production relay's")
+    parser.add_argument("--flush", action="store_true", help="flush the Redis database before starting")
+    parser.add_argument("--metrics-port", type=int, default=0, help="metrics port of the relay under test, 0 disables so it never clashes with a production relay")
+    parser.add_argument("--relay-log", help="file to write relay output to")
+    parser.add_argument("--seed", type=int, default=1)
+    options = parser.parse_args()
+    if options.redis_db == 0:
+        parser.error("--redis-db 0 is the production relay's database; use another one")
+    asyncio.run(run(options))
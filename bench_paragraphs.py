@@ -0,0 +1,92 @@
+import argparse
+import time
+import pymupdf
+from pdf_paragraphs import document_paragraphs, page_html_and_paragraphs
+
+
+def reference_paragraphs(doc, spacing_threshold=10, font_size_threshold=14, header_y_threshold=100, min_paragraph_length=20):
+    # The segmentation extract_paragraphs used before pdf_paragraphs, kept to check results and measure against
+    pdf_content = {}
+
+    for page_number, page in enumerate(doc):
+        text_dict = page.get_text("dict")
+        blocks = text_dict['blocks']
+
+        paragraphs = []
+        current_paragraph = []
+        previous_bottom = None
+
+        for block in blocks:
+            if 'lines' not in block:
+                continue
+
+            for line in block['lines']:
+                for span in line['spans']:
+                    top = span['bbox'][1]
+                    bottom = span['bbox'][3]
+                    text = span['text']
+                    font_size = span['size']
+
+                    if (font_size > font_size_threshold and top < header_y_threshold) or len(text.strip()) < min_paragraph_length:
+                        continue
+
+                    if previous_bottom is not None and (top - previous_bottom) > spacing_threshold:
+                        if len(" ".join(current_paragraph).strip()) >= min_paragraph_length:
+                            paragraphs.append(" ".join(current_paragraph).strip())
+                        current_paragraph = []
+
+                    current_paragraph.append(text)
+                    previous_bottom = bottom
+
+        if current_paragraph and len(" ".join(current_paragraph).strip()) >= min_paragraph_length:
+            paragraphs.append(" ".join(current_paragraph).strip())
+
+        pdf_content[page_number] = paragraphs
+
+    return pdf_content
+
+
+def reference_pages(doc):
+    # Page HTML and paragraphs as two separate extractions, as stored for every page before
+    return [(page.get_text("html"), paragraphs) for page, paragraphs in zip(doc, reference_paragraphs(doc).values())]
+
+
+def current_pages(doc):
+    return [page_html_and_paragraphs(page) for page in doc]
+
+
+def best_time(function, doc, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(doc)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark paragraph segmentation against the previous implementation")
+    parser.add_argument("pdf_path", nargs="?", default="test.pdf")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per implementation; the fastest is reported")
+    options = parser.parse_args()
+
+    doc = pymupdf.open(options.pdf_path)
+    reference_time, expected = best_time(reference_paragraphs, doc, options.repeat)
+    current_time, result = best_time(document_paragraphs, doc, options.repeat)
+    reference_pages_time, expected_pages = best_time(reference_pages, doc, options.repeat)
+    current_pages_time, pages = best_time(current_pages, doc, options.repeat)
+    doc.close()
+
+    if result != expected or pages != expected_pages:
+        raise SystemExit("Results differ from the reference implementation")
+    paragraph_count = sum(len(paragraphs) for paragraphs in result.values())
+    print(f"{options.pdf_path}: {len(result)} pages, {paragraph_count} paragraphs, identical results")
+    print(f"reference: {reference_time * 1000:.1f}ms ({reference_time * 1000 / len(result):.2f}ms per page)")
+    print(f"current:   {current_time * 1000:.1f}ms ({current_time * 1000 / len(result):.2f}ms per page)")
+    print(f"speedup:   {reference_time / current_time:.2f}x")
+    print(f"HTML and paragraphs per page: reference {reference_pages_time * 1000:.1f}ms, "
+          f"current {current_pages_time * 1000:.1f}ms, speedup {reference_pages_time / current_pages_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
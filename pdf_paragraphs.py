@@ -0,0 +1,50 @@
+import pymupdf  # PyMuPDF
+
+# Text extraction without image blocks, which segmentation skips anyway; decoding them was most of the cost of "dict"
+PARAGRAPH_TEXT_FLAGS = pymupdf.TEXTFLAGS_DICT & ~pymupdf.TEXT_PRESERVE_IMAGES
+
+
+def page_paragraphs(page, spacing_threshold=10, font_size_threshold=14, header_y_threshold=100, min_paragraph_length=20, textpage=None):
+    # Spans are grouped into a paragraph until the vertical gap to the previous kept span exceeds spacing_threshold.
+    # A textpage already built for the page, e.g. for its HTML, saves analysing the page a second time.
+    paragraphs = []
+    current_paragraph = []
+    previous_bottom = None
+
+    for block in page.get_text("dict", flags=PARAGRAPH_TEXT_FLAGS, textpage=textpage)['blocks']:
+        # Only text blocks have lines
+        for line in block.get('lines', ()):
+            for span in line['spans']:
+                text = span['text']
+                _, top, _, bottom = span['bbox']
+
+                # Exclude spans that are likely headers based on font size, position, and length
+                if (span['size'] > font_size_threshold and top < header_y_threshold) or len(text.strip()) < min_paragraph_length:
+                    continue
+
+                # Every kept span is at least min_paragraph_length long once stripped, so a non-empty paragraph
+                # always qualifies and is joined exactly once
+                if current_paragraph and previous_bottom is not None and (top - previous_bottom) > spacing_threshold:
+                    paragraphs.append(" ".join(current_paragraph).strip())
+                    current_paragraph = []
+
+                current_paragraph.append(text)
+                previous_bottom = bottom
+
+    if current_paragraph:
+        paragraphs.append(" ".join(current_paragraph).strip())
+
+    return paragraphs
+
+
+def page_html_and_paragraphs(page, **thresholds):
+    # Pages without images are analysed once for both; an HTML textpage of a page with images would make
+    # segmentation decode every image again
+    textpage = page.get_textpage(flags=pymupdf.TEXTFLAGS_HTML)
+    shared = None if page.get_images() else textpage
+    return page.get_text("html", textpage=textpage), page_paragraphs(page, textpage=shared, **thresholds)
+
+
+def document_paragraphs(doc, start=0, **thresholds):
+    # One pass over the document: page number (counted from start) -> paragraphs
+    return {page_number: page_paragraphs(page, **thresholds) for page_number, page in enumerate(doc, start=start)}
@@ -0,0 +1,141 @@
+import struct
+from typing import Optional, Union
+
+import msgspec
+
+# Inbound frames decode straight into these structs; the tag field selects the struct and unknown fields are ignored.
+# Fields without a default are required, so a malformed frame fails as one msgspec.ValidationError.
+
+
+class BuzzrMessage(msgspec.Struct, tag_field="action"):
+    pass
+
+
+class Register(BuzzrMessage, tag="register"):
+    device_id: str
+    geohash: str
+
+
+class Broadcast(BuzzrMessage, tag="broadcast"):
+    device_id: str
+    geohash: str
+    message: str
+    # Left as the base64 text the device sent; the blob store decodes it once
+    base64_image: Optional[str] = None
+
+
+class Rebroadcast(BuzzrMessage, tag="rebroadcast"):
+    device_id: str
+    geohash: str
+    message_id: str
+
+
+class UpdateLocation(BuzzrMessage, tag="update_location"):
+    device_id: str
+    new_geohash: str
+    old_geohash: Optional[str] = None
+
+
+class FetchImage(BuzzrMessage, tag="fetch_image"):
+    image_id: str
+
+
+class CoreaderMessage(msgspec.Struct, tag_field="type"):
+    pass
+
+
+class CoreaderRegister(CoreaderMessage, tag="register"):
+    device_id: str
+    session_id: str
+    title: str
+
+
+class CoreaderUnregister(CoreaderMessage, tag="unregister"):
+    pass
+
+
+class Ready(CoreaderMessage, tag="ready"):
+    device_id: str
+    session_id: str
+    ready: bool
+
+
+class UploadChunk(CoreaderMessage, tag="upload_chunk"):
+    device_id: str
+    session_id: str
+    title: str
+    chunk_index: int
+    chunk_data: str
+
+
+class UploadStart(CoreaderMessage, tag="upload_start"):
+    device_id: str
+    session_id: str
+    title: str
+
+
+class UploadComplete(CoreaderMessage, tag="upload_complete"):
+    device_id: str
+    session_id: str
+    title: str
+    # Total bytes sent, checked against what was received before the file is published
+    size: Optional[int] = None
+
+
+class ListSessions(CoreaderMessage, tag="list_sessions"):
+    pass
+
+
+buzzr_decoder = msgspec.json.Decoder(Union[Register, Broadcast, Rebroadcast, UpdateLocation, FetchImage])
+coreader_decoder = msgspec.json.Decoder(Union[CoreaderRegister, CoreaderUnregister, Ready, UploadChunk, UploadStart, UploadComplete, ListSessions])
+# Header of device ids on cross-worker deliveries
+device_ids_decoder = msgspec.json.Decoder(list[str])
+# Paragraph lists of stored Coreader pages
+paragraphs_decoder = msgspec.json.Decoder(list[str])
+encoder = msgspec.json.Encoder()
+
+DecodeError = msgspec.DecodeError
+
+
+# Binary Coreader upload frames: session id length, UTF-8 session id, byte offset in the file, then raw file bytes
+UPLOAD_ID_LENGTH = struct.Struct(">H")
+UPLOAD_OFFSET = struct.Struct(">Q")
+
+
+def decode_upload_frame(frame):
+    # Returns the session id, the offset and a view of the file bytes without copying them
+    if len(frame) < UPLOAD_ID_LENGTH.size:
+        raise ValueError("Upload frame too short")
+    (id_length,) = UPLOAD_ID_LENGTH.unpack_from(frame, 0)
+    data_start = UPLOAD_ID_LENGTH.size + id_length + UPLOAD_OFFSET.size
+    if len(frame) < data_start:
+        raise ValueError("Upload frame too short")
+    session_id = bytes(frame[UPLOAD_ID_LENGTH.size:UPLOAD_ID_LENGTH.size + id_length]).decode("utf-8")
+    (offset,) = UPLOAD_OFFSET.unpack_from(frame, UPLOAD_ID_LENGTH.size + id_length)
+    return session_id, offset, memoryview(frame)[data_start:]
+
+
+def encode_upload_frame(session_id, offset, data):
+    session_id = session_id.encode("utf-8")
+    return UPLOAD_ID_LENGTH.pack(len(session_id)) + session_id + UPLOAD_OFFSET.pack(offset) + bytes(data)
+
+
+def message_tag(message):
+    return message.__struct_config__.tag
+
+
+async def dispatch(websocket, frame, decoder, handlers, messages, logger):
+    # Each frame is parsed and validated once, straight into its message struct, then handed to the
+    # handler for its type; messages counts frames by tag and invalid ones are logged and dropped
+    try:
+        message = decoder.decode(frame)
+    except DecodeError as e:
+        logger.warning("Discarding invalid message: %s", e)
+        return
+    messages.labels(message_tag(message)).inc()
+    await handlers[type(message)](websocket, message)
+
+
+def encode(value):
+    # Text frames for websocket clients; the encoder itself produces UTF-8 bytes
+    return encoder.encode(value).decode("utf-8")
@@ -0,0 +1,219 @@
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Default histogram buckets in seconds, from sub-millisecond Redis calls to multi-second fan-outs
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Buckets for sizes such as fan-out counts and queued bytes
+SIZE_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s[%(process)d] %(message)s"
+
+REGISTRY = []
+
+
+class Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, label_names=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.label_names:
+            self.children[()] = self.new_child()
+        registry.append(self)
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        # One child per combination of label values, created on first use
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} expects labels {self.label_names}")
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def format_labels(self, values, extra=()):
+        pairs = list(zip(self.label_names, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for values, child in list(self.children.items()):
+            lines.extend(child.expose(self, values))
+        return lines
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def expose(self, metric, values):
+        return [f"{metric.name}_total{metric.format_labels(values)} {self.value}"]
+
+
+class GaugeChild(CounterChild):
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def expose(self, metric, values):
+        return [f"{metric.name}{metric.format_labels(values)} {self.value}"]
+
+
+class Timer:
+    # Observes elapsed seconds as a context manager, or around every call as a decorator
+    def __init__(self, child):
+        self.child = child
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.start)
+
+    def __call__(self, function):
+        child = self.child
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - start)
+        else:
+            @functools.wraps(function)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - start)
+        return timed
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def expose(self, metric, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append(f"{metric.name}_bucket{metric.format_labels(values, [('le', bound)])} {cumulative}")
+        lines.append(f"{metric.name}_sum{metric.format_labels(values)} {self.sum}")
+        lines.append(f"{metric.name}_count{metric.format_labels(values)} {cumulative}")
+        return lines
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def new_child(self):
+        return GaugeChild()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self.children[()].dec(amount)
+
+    def set(self, value):
+        self.children[()].set(value)
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names, registry)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def time(self):
+        return Timer(self.children[()])
+
+
+def generate_latest(registry=REGISTRY):
+    lines = []
+    for metric in registry:
+        lines.extend(metric.expose())
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = generate_latest(self.registry)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line each
+        pass
+
+
+def start_metrics_server(port, host="127.0.0.1", registry=REGISTRY):
+    # Served from a daemon thread so scrapes never wait on the event loop; 0 disables the endpoint
+    if not port:
+        return None
+    handler = type("RegistryMetricsHandler", (MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def configure_logging(level="INFO"):
+    logging.basicConfig(level=getattr(logging, str(level).upper(), logging.INFO), format=LOG_FORMAT)
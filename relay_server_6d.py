@@ -2,9 +2,21 @@ import express
 import https
 import fs
 import socketio
+import logging
+from relay_metrics import Counter, Gauge, Histogram, SIZE_BUCKETS, configure_logging, start_metrics_server
 
 # Define the port your server will listen on
 port = 3001  # Replace with your desired port
+metrics_port = 9191
+
+logger = logging.getLogger("sixdegrees")
+
+CONNECTIONS = Gauge("sixdegrees_connections", "Connected clients")
+COMMANDS = Counter("sixdegrees_commands", "Commands received by specific type", ["specific"])
+# The specific types the relay handles; anything else a client sends is counted as "other" so labels stay bounded
+SPECIFIC_TYPES = {"SEARCH", "SEARCH_LISTING", "CAST_LISTING", "ATTACH", "RESULT", "CHAT", "RATING"}
+RECEIVERS = Histogram("sixdegrees_command_receivers", "Receivers listed in one command", buckets=SIZE_BUCKETS)
+COMMAND_SECONDS = Histogram("sixdegrees_command_seconds", "Time spent handling one command")
 
 # Define paths to your private key and certificate files
 private_key_path = '/home/niyid/git/Docs/6degrees.key'  # Replace with the path to your private key
@@ -30,7 +42,8 @@ connected_clients = {}
 # WebSocket connection handling
 @io.event
 def connect(socket):
-    print(f"New client connected: {socket}")
+    CONNECTIONS.inc()
+    logger.debug("New client connected: %s", socket)
 
     @socket.on('receive_command')
     def receive_command(data):
@@ -58,32 +71,35 @@ def connect(socket):
         listings = data.get('listings')
         resume = data.get('resume')
         swap = data.get('swap')
+        COMMANDS.labels(specific if specific in SPECIFIC_TYPES else "other").inc()
 
         # Your handling logic goes here
         pass
 
     @socket.event
     def disconnect():
+        CONNECTIONS.dec()
         device_id = next((key for key, value in connected_clients.items() if value == socket), None)
         if device_id:
             del connected_clients[device_id]
-            print(f"Client disconnected: {device_id}")
+            logger.debug("Client disconnected: %s", device_id)
 
-# Define a function for logging with timestamp
-def log_with_timestamp(message):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] {message}")
+# Define a function for logging with timestamp; the timestamp now comes from the log format
+def log_with_timestamp(message, level=logging.DEBUG):
+    logger.log(level, message)
 
 # Define a function to handle message command
+@COMMAND_SECONDS.time()
 def handle_message_command(
     deviceId, originDeviceId, command, receivers, specific, comment, currentSearchDepth,
     searchPathMap, MAX_DEPTH, cellphone, geozone, latitude, longitude, employmentSearchIds,
     employmentMatchIds, hops, rating, matchedDevices, listingCategoryId, query, listings, resume, swap
 ):
     if not isinstance(receivers, list) or len(receivers) == 0:
-        log_with_timestamp('Empty receivers list.')
+        log_with_timestamp('Empty receivers list.', logging.INFO)
         return
 
+    RECEIVERS.observe(len(receivers))
     log_with_timestamp(f'Receiver count: {len(receivers)}')
     for receiver in receivers:
         if connected_clients.get(receiver) and receiver != deviceId:
@@ -149,5 +165,7 @@ def index():
 
 # Start the server
 if __name__ == '__main__':
+    configure_logging()
+    start_metrics_server(metrics_port)
     server.listen(port)
-    print(f"Server listening on port {port}")
+    logger.info("Server listening on port %d", port)
@@ -1,25 +1,148 @@
 import websockets
 import asyncio
+import argparse
+import multiprocessing
+import os
+import socket
 import ssl
 import json
+import base64
+import binascii
+import hashlib
+import logging
 import geohash2
 import random
+import re
 import uuid
-import redis
+from redis import asyncio as aioredis
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from functools import lru_cache
+from scipy.sparse import csr_matrix, vstack
 from math import radians, sin, cos, sqrt, atan2, ceil
 from datetime import datetime, timedelta
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.feature_extraction.text import HashingVectorizer
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from geopy.distance import geodesic
+import relay_messages
+from relay_messages import Register, Broadcast, Rebroadcast, UpdateLocation, FetchImage
+from relay_metrics import Counter, Gauge, Histogram, SIZE_BUCKETS, configure_logging, start_metrics_server
+from relay_workers import WorkerPool
+
+logger = logging.getLogger("buzzr")
+
+# Bundled per-language keyword sets; English is built into IncidentClassifier
+KEYWORDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "incident_keywords")
+DEFAULT_LANGUAGE = "English"
+# Processes for CPU-bound broadcast work (0 runs it inline), and how many jobs may wait for them
+COMPUTE_WORKERS = os.cpu_count() or 1
+COMPUTE_QUEUE_LIMIT = 64
+
+# Redis GEO set of every occupied geohash cell, keyed by the cell's center
+GEOHASH_INDEX_KEY = "geohash_index"
+# Devices are placed in cells of this geohash length (about 150 m); moves inside a cell change nothing
+INDEX_PRECISION = 7
+# Location updates from one device arriving within this many seconds are applied as one move
+LOCATION_COALESCE_SECONDS = 1.0
+# Outer radius of the last propagation annulus
+MAX_PROPAGATION_KM = 180
+# Width of each propagation annulus
+BAND_WIDTH_KM = 20
+# Sorted set of incident ids scored by incident time (epoch seconds)
+INCIDENT_TIME_KEY = "incident_times"
+# Redis GEO set of incident ids at the center of their geohash
+INCIDENT_LOCATION_KEY = "incident_locations"
+# Sorted set of incident ids scored by expiration time, driving secondary index cleanup
+INCIDENT_EXPIRY_KEY = "incident_expiries"
+INCIDENT_TTL_SECONDS = 2 * 24 * 3600
+# Set of the one-time migrations of stored data already applied
+MIGRATIONS_KEY = "migrations"
+# Expired incidents are cleaned up this many at a time, checking again after the interval once caught up
+EXPIRY_BATCH_SIZE = 200
+EXPIRY_INTERVAL_SECONDS = 60
+# Images live as long as the incidents that reference them
+IMAGE_TTL_SECONDS = INCIDENT_TTL_SECONDS
+# Hashed term space for incident text vectors
+SIMILARITY_FEATURES = 2 ** 18
+SIMILARITY_THRESHOLD = 0.8
+# Fan-out limits: concurrent sends per broadcast, seconds before a send gives up,
+# and bytes already queued on a socket before further messages to it are dropped
+SEND_CONCURRENCY = 256
+SEND_TIMEOUT_SECONDS = 5
+SEND_QUEUE_LIMIT = 4 * 1024 * 1024
+# Hash of device id -> id of the worker process holding its socket
+DEVICE_WORKERS_KEY = "device_workers"
+# Pub/sub channel prefix on which each worker receives deliveries for its devices
+DELIVERY_CHANNEL_PREFIX = "deliveries:"
+# Set of device ids registered through each worker, and a key that exists while the worker is alive
+WORKER_DEVICES_PREFIX = "worker_devices:"
+WORKER_ALIVE_PREFIX = "worker_alive:"
+# Sockets are pinged every HEARTBEAT_INTERVAL_SECONDS and closed if no pong arrives within IDLE_TIMEOUT_SECONDS
+HEARTBEAT_INTERVAL_SECONDS = 20
+IDLE_TIMEOUT_SECONDS = 20
+# How often Redis membership is checked against live sockets
+RECONCILE_INTERVAL_SECONDS = 300
+# Background loops that fail on Redis wait this long before retrying, doubling up to the maximum
+RETRY_INITIAL_SECONDS = 1
+RETRY_MAX_SECONDS = 60
+# Redis holding the relay's shared state, and the connections shared by the relay and the geohash tree
+REDIS_HOST = "localhost"
+REDIS_PORT = 6379
+REDIS_DB = 0
+REDIS_POOL_SIZE = 64
+REDIS_POOL_TIMEOUT = 10
+# Metrics are served per worker on METRICS_PORT plus the worker index
+METRICS_PORT = 9171
+
+CONNECTIONS = Gauge("buzzr_connections", "Open device websockets")
+MESSAGES = Counter("buzzr_messages", "Messages received from devices", ["action"])
+FANOUT = Histogram("buzzr_broadcast_fanout_devices", "Devices sampled for one propagation", buckets=SIZE_BUCKETS)
+DELIVERIES = Counter("buzzr_deliveries", "Payload sends to local devices by outcome", ["outcome"])
+SEND_QUEUE_BYTES = Histogram("buzzr_send_queue_bytes", "Bytes already queued on a socket when a payload is sent to it", buckets=SIZE_BUCKETS)
+FIND_SIMILAR_SECONDS = Histogram("buzzr_find_similar_incidents_seconds", "Time spent in find_similar_incidents")
+PROPAGATE_SECONDS = Histogram("buzzr_propagate_seconds", "Time spent in propagate, planning through delivery")
+COMPUTE_SECONDS = Histogram("buzzr_compute_seconds", "Time spent in CPU-bound stages including the pool queue", ["stage"])
+REDIS_SECONDS = Histogram("buzzr_redis_seconds", "Redis round trips by command", ["command"])
+# Haversine on a sphere differs from the WGS-84 geodesic by at most about 0.6%
+HAVERSINE_TOLERANCE = 0.006
+
+# SREM a device from its cell and drop the cell from the spatial index once it is empty
+REMOVE_MEMBER_SCRIPT = """
+redis.call('SREM', KEYS[1], ARGV[1])
+if redis.call('SCARD', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[2])
+end
+"""
+
+# Atomically move a device from the cell in its user record to a new cell.
+# KEYS: user:{device_id}, spatial index. ARGV: device id, new cell, lon, lat, user record, force.
+# Returns 0 without writing when the device is already in the new cell, unless forced.
+MOVE_MEMBER_SCRIPT = """
+local previous = redis.call('GET', KEYS[1])
+local old_cell = false
+if previous then
+    local user_data = cjson.decode(previous)
+    old_cell = user_data['cell'] or user_data['geohash']
+end
+if old_cell == ARGV[2] and ARGV[6] == '0' then
+    return 0
+end
+if old_cell and old_cell ~= ARGV[2] then
+    redis.call('SREM', 'geohash_users:' .. old_cell, ARGV[1])
+    if redis.call('SCARD', 'geohash_users:' .. old_cell) == 0 then
+        redis.call('ZREM', KEYS[2], old_cell)
+    end
+end
+redis.call('SADD', 'geohash_users:' .. ARGV[2], ARGV[1])
+redis.call('GEOADD', KEYS[2], ARGV[3], ARGV[4], ARGV[2])
+redis.call('SET', KEYS[1], ARGV[5])
+return 1
+"""
 
 class IncidentClassifier:
-    def __init__(self):
+    def __init__(self, keyword_mapping=None):
         # Define keywords for each incident category
-        self.keyword_mapping = {
+        self.keyword_mapping = keyword_mapping or {
             "ACCIDENT": ["accident", "crash"],
             "ROBBERY": ["robbery", "theft"],
             "FLOOD": ["water", "rain"],
@@ -33,129 +156,382 @@ class IncidentClassifier:
             "DEATH": ["murder", "suicide", "killed", "bloodbath"],
             "UNEXPLAINED": ["UFO", "lights", "unknown", "strange"]
         }
+        self.compile()
 
-    def predict(self, text):
-        # Set language to English
-        language = "English"
-        # Convert text to lowercase for case-insensitive matching
-        text_lower = text.lower()
-        # Check for keywords in the text and return the corresponding incident label
+    def compile(self):
+        # Every keyword of every label goes into one case-insensitive pattern, so a message is scanned once
+        # however large the vocabulary; a keyword matches at the start of a word ("crash" in "crashed")
+        self.keyword_labels = {}
         for label, keywords in self.keyword_mapping.items():
             for keyword in keywords:
-                if keyword in text_lower:
-                    return label
+                self.keyword_labels.setdefault(keyword.lower(), []).append(label)
+        # Longest first so a keyword is never shadowed by a shorter one it starts with
+        alternatives = sorted(self.keyword_labels, key=len, reverse=True)
+        self.pattern = re.compile(r"\b(" + "|".join(re.escape(keyword) for keyword in alternatives) + r")\w*", re.IGNORECASE)
+
+    def predict_scores(self, text):
+        # All matching labels with their scores, best first
+        scores = {}
+        for match in self.pattern.finditer(text):
+            keyword = match.group(1).lower()
+            for label in self.keyword_labels[keyword]:
+                # A keyword naming its label outright ("theft" for THEFT) outweighs one shared with other labels
+                scores[label] = scores.get(label, 0) + (1.5 if keyword == label.lower() else 1)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    def predict(self, text):
+        scores = self.predict_scores(text)
         # If no keyword matches found, return "UNKNOWN"
-        return "UNKNOWN"
-    
+        return scores[0][0] if scores else "UNKNOWN"
+
+    def predict_many(self, texts):
+        return [self.predict(text) for text in texts]
+
+class ClassificationPipeline:
+    def __init__(self, keywords_path=KEYWORDS_PATH):
+        self.keywords_path = keywords_path
+        with open(os.path.join(keywords_path, "languages.json"), encoding="utf-8") as languages_file:
+            self.language_info = json.load(languages_file)
+        self.stopwords = {language: set(info['stopwords']) for language, info in self.language_info.items()}
+        # Keyword sets are only read and compiled the first time a language is seen
+        self.classifier = lru_cache(maxsize=None)(self.load_classifier)
+
+    def load_classifier(self, language):
+        keywords_file = self.language_info.get(language, {}).get('file')
+        if keywords_file is None:
+            return IncidentClassifier()
+        with open(os.path.join(self.keywords_path, keywords_file), encoding="utf-8") as f:
+            return IncidentClassifier(json.load(f))
+
     def detect_language(self, text):
-        return "English"
-        
+        # The language whose stopwords occur most often, falling back to English
+        words = re.findall(r"\w+", text.lower())
+        scores = {language: sum(word in stopwords for word in words) for language, stopwords in self.stopwords.items()}
+        language = max(scores, key=scores.get, default=DEFAULT_LANGUAGE)
+        return language if scores.get(language) else DEFAULT_LANGUAGE
+
+    def predict(self, text, language=None):
+        return self.classifier(language or self.detect_language(text)).predict(text)
+
+    def classify(self, text):
+        language = self.detect_language(text)
+        return self.predict(text, language), language
+
+# CPU-bound broadcast stages. These run in the compute processes, each of which keeps its own
+# classifier and similarity engine in compute_state across jobs.
+compute_state = {}
+
+def compute_context():
+    if not compute_state:
+        geo_tree = GeoHashTree(None)
+        compute_state.update(
+            geo_tree=geo_tree,
+            similarity_engine=SimilarityEngine(),
+            incident_classifier=ClassificationPipeline()
+        )
+    return compute_state
+
+def compute_classification(text):
+    return compute_context()['incident_classifier'].classify(text)
+
+def compute_vector(text):
+    similarity_engine = compute_context()['similarity_engine']
+    return similarity_engine.serialize(similarity_engine.vectorize(text))
+
+def compute_similarity(message_text, vector_values, other_message_texts):
+    similarity_engine = compute_context()['similarity_engine']
+    vectors = []
+    for vector_value, other_message_text in zip(vector_values, other_message_texts):
+        if vector_value:
+            vectors.append(similarity_engine.deserialize(vector_value))
+        else:
+            vectors.append(similarity_engine.vectorize(other_message_text))
+    return similarity_engine.score(similarity_engine.vectorize(message_text), vectors)
+
+def compute_distances(geohash, geohashes, radius_km):
+    geo_tree = compute_context()['geo_tree']
+    lats, lons = geo_tree.decode_cells(geohashes)
+    return geo_tree.batch_distances(geohash, lats, lons, boundaries=[radius_km]).tolist()
+
+def compute_bands(geohash, lats, lons):
+    # Annulus of every cell center, -1 beyond the outermost one; all cells are measured in one vectorized
+    # call, with those near an annulus boundary measured exactly
+    band_count = ceil(MAX_PROPAGATION_KM / BAND_WIDTH_KM)
+    boundaries = [band * BAND_WIDTH_KM for band in range(1, band_count + 1)]
+    distances = compute_context()['geo_tree'].batch_distances(geohash, lats, lons, boundaries=boundaries)
+    bands = np.minimum(distances // BAND_WIDTH_KM, band_count - 1).astype(np.int64)
+    bands[distances > MAX_PROPAGATION_KM] = -1
+    return bands.tolist()
+
+
+class InstrumentedPipeline(aioredis.client.Pipeline):
+    async def execute(self, raise_on_error=True):
+        with REDIS_SECONDS.labels("PIPELINE").time():
+            return await super().execute(raise_on_error)
+
+
+class InstrumentedRedis(aioredis.Redis):
+    # Every direct command and pipeline flush is timed; commands queued on a pipeline count towards its flush
+    async def execute_command(self, *args, **options):
+        with REDIS_SECONDS.labels(args[0]).time():
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
 class RelayServer:
     def __init__(self):
-        self.geo_tree = GeoHashTree()
+        self.connect_redis()
         self.active_connections = {}
-        self.redis_conn = redis.StrictRedis(host='localhost', port=6379, db=0)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.delivery_tasks = set()
+        self.pending_locations = {}
+        # Devices registered through each socket, so they can be released when it closes
+        self.connection_devices = {}
+        self.location_tasks = set()
         self.labels = set(["ACCIDENT", "ROBBERY", "KIDNAPPING", "FIRE", "NATURAL DISASTER", "FIGHT", "THEFT", "VANDALISM", "ASSAULT", "UNEXPLAINED", "DEATH"])
         self.languages = set()
-        self.vectorizer = TfidfVectorizer()
-        self.incident_classifier = IncidentClassifier()
+        self.incident_classifier = ClassificationPipeline()
+        # At most COMPUTE_QUEUE_LIMIT jobs are queued; further broadcasts wait while the loop keeps serving sockets
+        self.compute_pool = WorkerPool(COMPUTE_WORKERS, COMPUTE_SECONDS, queue_limit=COMPUTE_QUEUE_LIMIT)
+
+    def connect_redis(self, host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB):
+        redis_pool = aioredis.BlockingConnectionPool(host=host, port=port, db=db, max_connections=REDIS_POOL_SIZE, timeout=REDIS_POOL_TIMEOUT)
+        self.redis_conn = InstrumentedRedis(connection_pool=redis_pool)
+        self.geo_tree = GeoHashTree(self.redis_conn)
 
-    async def insert_incident(self, message_data):
+    async def insert_incident(self, message_data, incident_time, expiration_time):
         message_id = message_data['message_id']
-        print(f"insert_incident {message_id} -> {message_data}")
-        self.redis_conn.set(f"message:{message_id}", json.dumps(message_data))
+        logger.debug("insert_incident %s -> %s", message_id, message_data)
+
+        # The text vector is computed once here and reused by every later similarity query
+        vector_value = await self.compute_pool.run(compute_vector, message_data['message'])
+
+        lat, lon = geohash2.decode(message_data['geohash'])
+        async with self.redis_conn.pipeline() as pipe:
+            # Redis drops the incident itself when it expires; the sorted set tells the sweep what to unindex
+            pipe.set(f"message:{message_id}", json.dumps(message_data), exat=int(expiration_time.timestamp()))
+            pipe.set(f"message_vector:{message_id}", vector_value, exat=int(expiration_time.timestamp()))
+            pipe.zadd(INCIDENT_TIME_KEY, {message_id: incident_time.timestamp()})
+            pipe.zadd(INCIDENT_EXPIRY_KEY, {message_id: expiration_time.timestamp()})
+            pipe.geoadd(INCIDENT_LOCATION_KEY, (float(lon), float(lat), message_id))
+            await pipe.execute()
+
+    async def get_incident(self, message_id):
+        return json.loads(await self.redis_conn.get(f"message:{message_id}") or '{}')
+
+    async def store_image(self, base64_image):
+        # Images are stored once, decoded, under the hash of their content; broadcasts carry only the hash
+        if not base64_image:
+            return ''
+        try:
+            image_data = base64.b64decode(base64_image)
+        except (binascii.Error, ValueError) as e:
+            logger.warning("Discarding undecodable image: %s", e)
+            return ''
+
+        image_id = hashlib.sha256(image_data).hexdigest()
+        async with self.redis_conn.pipeline() as pipe:
+            pipe.set(f"image:{image_id}", image_data, ex=IMAGE_TTL_SECONDS, nx=True)
+            # A repeated image keeps living as long as its newest incident
+            pipe.expire(f"image:{image_id}", IMAGE_TTL_SECONDS)
+            await pipe.execute()
+        return image_id
+
+    async def fetch_image(self, websocket, image_id):
+        image_data = await self.redis_conn.get(f"image:{image_id}")
+        if image_data is None:
+            logger.info("Image %s not found", image_id)
+        base64_image = base64.b64encode(image_data).decode("ascii") if image_data else ''
+        await websocket.send(relay_messages.encode({"action": "image", "image_id": image_id, "base64_image": base64_image}))
 
     async def remove_incident(self, message_id):
-        await self.redis_conn.delete(f"message:{message_id}")
+        async with self.redis_conn.pipeline() as pipe:
+            pipe.delete(f"message:{message_id}", f"message_vector:{message_id}")
+            pipe.zrem(INCIDENT_TIME_KEY, message_id)
+            pipe.zrem(INCIDENT_LOCATION_KEY, message_id)
+            pipe.zrem(INCIDENT_EXPIRY_KEY, message_id)
+            await pipe.execute()
         
+    @FIND_SIMILAR_SECONDS.time()
     async def find_similar_incidents(self, geohash, current_time, message_text):
         similar_incidents = []
         radius_km = 10
         time_window_seconds = 30 * 60  # 30 minutes in seconds
         time_window_delta = timedelta(seconds=time_window_seconds)
         # Get messages within the specified radius and time window
-        messages_within_radius = self.get_messages_within_radius(geohash, radius_km, current_time - time_window_delta, current_time + time_window_delta)
+        messages_within_radius = await self.get_messages_within_radius(geohash, radius_km, current_time - time_window_delta, current_time + time_window_delta)
         
-        # Iterate over the messages and filter by similarity
-        for message_info in messages_within_radius:
+        if not messages_within_radius:
+            return similar_incidents
+
+        # Score the message against every candidate's stored vector in one sparse product
+        vector_keys = [f"message_vector:{message_info['message_id']}" for message_info in messages_within_radius]
+        vector_values = await self.redis_conn.mget(vector_keys)
+        other_message_texts = [message_info['message'] for message_info in messages_within_radius]
+        similarity_scores = await self.compute_pool.run(compute_similarity, message_text, vector_values, other_message_texts)
+
+        for message_info, similarity_score in zip(messages_within_radius, similarity_scores):
             other_message_text = message_info['message']
-            similarity_score = self.calculate_similarity(message_text, other_message_text)
             #print(f"{message_text} ~ {other_message_text} = {similarity_score}")
-            if similarity_score > 0.8:  # Adjust the threshold as needed
+            if similarity_score > SIMILARITY_THRESHOLD:  # Adjust the threshold as needed
                 message_id = message_info['message_id']
                 similar_incidents.append({'message_id': message_id, 'message_text': other_message_text})
 
         return similar_incidents
 
-    def get_messages_within_radius(self, geohash, radius_km, start_time, end_time):
-        messages_within_radius = []
-        message_keys = self.redis_conn.keys("message:*")
-        
-        for message_key in message_keys:
-            message_info = json.loads(self.redis_conn.get(message_key) or '{}')
+    async def get_messages_within_radius(self, geohash, radius_km, start_time, end_time):
+        lat, lon = geohash2.decode(geohash)
+        # Candidates must be in both the time slice and the spatial slice; the spatial search is widened
+        # by the haversine error so the exact check below decides incidents near the edge
+        async with self.redis_conn.pipeline(transaction=False) as pipe:
+            pipe.zrangebyscore(INCIDENT_TIME_KEY, start_time.timestamp(), end_time.timestamp())
+            pipe.geosearch(INCIDENT_LOCATION_KEY, longitude=float(lon), latitude=float(lat), radius=radius_km * (1 + HAVERSINE_TOLERANCE) + 0.01, unit='km')
+            ids_in_window, ids_nearby = await pipe.execute()
 
-            message_time = datetime.strptime(message_info['incident_time'], '%Y-%m-%d %H:%M:%S')
-            message_geohash = message_info['geohash']
-            
-            if self.geo_tree.calculate_distance(geohash, message_geohash) <= radius_km and start_time <= message_time <= end_time:
-                messages_within_radius.append(message_info)
+        ids_nearby = set(ids_nearby)
+        message_keys = [f"message:{message_id.decode('utf-8')}" for message_id in ids_in_window if message_id in ids_nearby]
+        if not message_keys:
+            return []
 
-        return messages_within_radius
+        messages_within_radius = [json.loads(message_value) for message_value in await self.redis_conn.mget(message_keys) if message_value]
+        if not messages_within_radius:
+            return messages_within_radius
 
-    def calculate_similarity(self, text1, text2):
-        # Fit TF-IDF vectorizer on text1 and transform both text1 and text2
-        tfidf_matrix = self.vectorizer.fit_transform([text1, text2])
-        # Compute cosine similarity between the transformed vectors
-        similarity_score = cosine_similarity(tfidf_matrix)[0, 1]
-        return similarity_score
-    
-    def add_incident_label(self, label, language):
-        self.redis_conn.set(f"label:{label}:{language}", 1)
+        # Measure every candidate in one pass, refining only those close to the radius
+        distances = await self.compute_pool.run(compute_distances, geohash, [message_info['geohash'] for message_info in messages_within_radius], radius_km)
+        return [message_info for message_info, distance in zip(messages_within_radius, distances) if distance <= radius_km]
 
-    def get_incident_labels(self, language):
-        labels = self.redis_conn.keys(f"label:*:{language}")
+    async def add_incident_label(self, label, language):
+        await self.redis_conn.set(f"label:{label}:{language}", 1)
+
+    async def get_incident_labels(self, language):
+        labels = await self.redis_conn.keys(f"label:*:{language}")
         return [label.decode().split(':')[1] for label in labels]
 
-    def get_incident_description(self, text):
+    async def get_incident_description(self, text):
         try:
-            language = self.incident_classifier.detect_language(text)
-            self.languages.add(language)
-            label = self.incident_classifier.predict(text)
-            return label, language
-        except:
+            label, language = await self.compute_pool.run(compute_classification, text)
+        except Exception as e:
+            logger.exception("An error occurred during incident classification: %s", e)
             return "UNKNOWN", "UNKNOWN"
+
+        if language not in self.languages:
+            # Record the labels available in each language the first time it is seen
+            self.languages.add(language)
+            for language_label in self.incident_classifier.classifier(language).keyword_mapping:
+                await self.add_incident_label(language_label, language)
+        return label, language
         
     async def register(self, websocket, device_id, geohash):
-        print(f"Registered device {device_id} at geohash {geohash}")
+        logger.debug("Registered device %s at geohash %s", device_id, geohash)
         user_data = {'device_id': device_id, 'geohash': geohash}
-        await self.geo_tree.insert_user(user_data)
         self.active_connections[device_id] = websocket
+        self.connection_devices.setdefault(websocket, set()).add(device_id)
+        # Ownership is recorded before the device is placed, so a user record never exists without an owner
+        async with self.redis_conn.pipeline() as pipe:
+            pipe.hset(DEVICE_WORKERS_KEY, device_id, self.worker_id)
+            pipe.sadd(f"{WORKER_DEVICES_PREFIX}{self.worker_id}", device_id)
+            await pipe.execute()
+        await self.geo_tree.insert_user(user_data)
+
+    async def disconnect(self, websocket):
+        # A closed socket takes its devices out of memory and out of the spatial index
+        for device_id in self.connection_devices.pop(websocket, set()):
+            if self.active_connections.get(device_id) is websocket:
+                del self.active_connections[device_id]
+                self.pending_locations.pop(device_id, None)
+                logger.debug("Disconnected device %s", device_id)
+                await self.release_device(device_id, self.worker_id)
+
+    async def release_device(self, device_id, worker_id):
+        # A device that has since registered through another worker belongs to that worker and is left alone
+        owner = await self.redis_conn.hget(DEVICE_WORKERS_KEY, device_id)
+        if owner is None or owner.decode("utf-8") == worker_id:
+            await self.geo_tree.remove_user(device_id)
+            await self.redis_conn.hdel(DEVICE_WORKERS_KEY, device_id)
+        await self.redis_conn.srem(f"{WORKER_DEVICES_PREFIX}{worker_id}", device_id)
+
+    async def reconcile(self, clean_up_workers=False):
+        # Runs for the life of the worker; a failed pass is retried after a backoff rather than ending the task
+        retry_seconds = RETRY_INITIAL_SECONDS
+        while True:
+            try:
+                await self.reconcile_devices(clean_up_workers)
+            except Exception as e:
+                logger.exception("Reconciliation failed, retrying in %ds: %s", retry_seconds, e)
+                await asyncio.sleep(retry_seconds)
+                retry_seconds = min(retry_seconds * 2, RETRY_MAX_SECONDS)
+                continue
+            retry_seconds = RETRY_INITIAL_SECONDS
+            await asyncio.sleep(RECONCILE_INTERVAL_SECONDS)
+
+    async def reconcile_devices(self, clean_up_workers=False):
+        await self.redis_conn.set(f"{WORKER_ALIVE_PREFIX}{self.worker_id}", 1, ex=RECONCILE_INTERVAL_SECONDS * 3)
 
-    async def unregister(self, device_id, geohash):
-        print(f"Unregistered device {device_id}")
-        await self.geo_tree.remove_user(device_id)
+        # Devices recorded for this worker without a live socket
+        stale_device_ids = []
+        async for device_id in self.redis_conn.sscan_iter(f"{WORKER_DEVICES_PREFIX}{self.worker_id}"):
+            if device_id.decode("utf-8") not in self.active_connections:
+                stale_device_ids.append(device_id.decode("utf-8"))
+        for device_id in stale_device_ids:
+            await self.release_device(device_id, self.worker_id)
 
-    async def update_location(self, device_id, old_geohash, new_geohash):
-        print(f"Updated location for device {device_id} to geohash {new_geohash}")
-        await self.unregister(device_id, old_geohash)
-        await self.register(self.active_connections[device_id], device_id, new_geohash)
+        # Devices of workers that stopped without releasing them
+        if clean_up_workers:
+            async for worker_key in self.redis_conn.scan_iter(f"{WORKER_DEVICES_PREFIX}*"):
+                worker_id = worker_key.decode("utf-8").replace(WORKER_DEVICES_PREFIX, "", 1)
+                if worker_id == self.worker_id or await self.redis_conn.exists(f"{WORKER_ALIVE_PREFIX}{worker_id}"):
+                    continue
+                worker_device_ids = [device_id.decode("utf-8") async for device_id in self.redis_conn.sscan_iter(worker_key)]
+                for device_id in worker_device_ids:
+                    await self.release_device(device_id, worker_id)
+                stale_device_ids.extend(worker_device_ids)
+
+        if stale_device_ids:
+            logger.info("Reconciled %d devices without a live connection", len(stale_device_ids))
+
+    async def update_location(self, websocket, device_id, old_geohash, new_geohash):
+        # Only devices registered through this socket may move; anything else would leave a user record
+        # and cell membership that no worker owns or reconciles
+        if self.active_connections.get(device_id) is not websocket:
+            logger.debug("Ignoring location update for unregistered device %s", device_id)
+            return
+        # Only the newest location is kept; one move per device is applied after a short delay
+        already_pending = device_id in self.pending_locations
+        self.pending_locations[device_id] = new_geohash
+        if not already_pending:
+            task = asyncio.create_task(self.apply_location(device_id))
+            self.location_tasks.add(task)
+            task.add_done_callback(self.location_tasks.discard)
+
+    async def apply_location(self, device_id):
+        await asyncio.sleep(LOCATION_COALESCE_SECONDS)
+        new_geohash = self.pending_locations.pop(device_id, None)
+        # The device disconnected while its move was pending
+        if new_geohash is None or device_id not in self.active_connections:
+            return
+        if await self.geo_tree.move_user(device_id, new_geohash):
+            logger.debug("Updated location for device %s to geohash %s", device_id, new_geohash)
 
     async def broadcast(self, websocket, device_id, geohash, message, base64_image):
-        incident_label, language = self.get_incident_description(message)
+        incident_label, language = await self.get_incident_description(message)
         # Add detected incident label dynamically
         # if incident_label not in self.labels:
         #     self.labels.add(incident_label)
-        #     self.add_incident_label(incident_label, language)
+        #     await self.add_incident_label(incident_label, language)
         
         message_id = str(uuid.uuid4())
         current_time = datetime.fromtimestamp(datetime.now().timestamp())
-        expiration_time = current_time + timedelta(days=2)
+        expiration_time = current_time + timedelta(seconds=INCIDENT_TTL_SECONDS)
         
         # Prepend incident label to the message
         message_with_label = f"{incident_label}: {message}"
     
         # Find similar incidents within 10km radius around the same time
         similar_incidents = await self.find_similar_incidents(geohash, current_time, message)
+        image_id = await self.store_image(base64_image)
         
         message_data = {
             'action': 'broadcast',
@@ -166,19 +542,19 @@ class RelayServer:
             'device_id': device_id,
             'incident_label': incident_label,
             'incident_time': current_time.strftime('%Y-%m-%d %H:%M:%S'), 
-            'base64_image': base64_image,
+            'image_id': image_id,
             'similar_incidents': json.dumps(similar_incidents)
         }
 
-        await self.insert_incident(message_data)
+        await self.insert_incident(message_data, current_time, expiration_time)
         
-        #print(f"Broadcast image: {base64_image}")
+        #print(f"Broadcast image: {image_id}")
         
         if message_data:
-            print(f"Broadcast sent from device {device_id} at geohash {geohash} - {message_id}")  
+            logger.debug("Broadcast sent from device %s at geohash %s - %s", device_id, geohash, message_id)
             await self.propagate(geohash, message_data, device_id)
         else:
-            print(f"Cannot broadcast - invalid message_id {message_id}") 
+            logger.warning("Cannot broadcast - invalid message_id %s", message_id)
 
         # Test similar incidents TODO - comment out later
         # sim_incidents = [
@@ -189,104 +565,218 @@ class RelayServer:
         # ]
 
         # Send echo to sender for testing. TODO - comment out later
-        #await websocket.send(json.dumps({"action": "broadcast", "message_id": message_id, "base64_image": base64_image, "similar_incidents": json.dumps(similar_incidents), "message": "TESTECHO-" + message_with_label}))
+        #await websocket.send(json.dumps({"action": "broadcast", "message_id": message_id, "image_id": image_id, "similar_incidents": json.dumps(similar_incidents), "message": "TESTECHO-" + message_with_label}))
 
     async def rebroadcast(self, websocket, device_id, geohash, message_id):
-        message_key = f"message:{message_id}"
-        message_info = json.loads(self.redis_conn.get(message_key) or '{}')
+        message_info = await self.get_incident(message_id)
         data = {key: value for key, value in message_info.items()}
         if message_info:
-            print(f"Rebroadcast sent from device {device_id} at geohash {geohash} - {message_id}")  
+            logger.debug("Rebroadcast sent from device %s at geohash %s - %s", device_id, geohash, message_id)
             await self.propagate(geohash, message_info, device_id)
         else:
-            print(f"Cannot rebroadcast - invalid message_id {message_id}") 
+            logger.warning("Cannot rebroadcast - invalid message_id %s", message_id)
             
         # Send echo to sender for testing. TODO - comment out later
-        await websocket.send(json.dumps({"action": "rebroadcast", "message_id": message_id, "message": data['message'], "message": data['base64_image']}))                 
-
-    def within_bounds(self, lower, upper, geohash, geohash_2, geo_key):
-        target_lat, target_lon = geohash2.decode(geohash_2)
-        lat, lon = geohash2.decode(geohash)
-        
-        # Calculate the distance between the center and the specified location
-        distance = geodesic((lat, lon), (target_lat, target_lon)).kilometers
-        
-        # If the distance is within the radius, add the geohash to users_within_radius
-        users_data = []
-        if distance <= upper and distance >= lower:
-            users_data = json.loads(self.redis_conn.hget(geo_key, 'users') or '[]')
+        await websocket.send(relay_messages.encode({"action": "rebroadcast", "message_id": message_id, "message": data['message'], "image_id": data.get('image_id', '')}))                 
 
-        attenuation = self.geo_tree.calculate_attenuation(lower)
-        # Randomly select users in this annulus based on the attenuation
-        num_users = int(ceil(attenuation) * len(users_data))
-        selected_users = random.sample(users_data, num_users)
-        #print(f"within_bounds {lower} - {upper} within {distance} of {len(users_data)} users @ {geohash_2} from {geohash}")
+    async def sample_users(self, targets):
+        # Randomly select users in each annulus based on the attenuation, sampled by Redis itself.
+        # Counting and sampling each run as one pipelined round trip for all target cells.
+        counts = await self.geo_tree.count_cell_users([geohash for geohash, _ in targets])
+        samples = []
+        for (geohash, lower), count in zip(targets, counts):
+            attenuation = self.geo_tree.calculate_attenuation(lower)
+            num_users = int(ceil(attenuation) * count)
+            if num_users > 0:
+                samples.append((geohash, num_users))
+        #print(f"sample_users selected {sum(num_users for _, num_users in samples)} users in {len(samples)} cells")
 
-        return selected_users
-        
+        return await self.geo_tree.sample_cell_users(samples)
 
+    @PROPAGATE_SECONDS.time()
     async def propagate(self, geohash, message_info, source_id):
         if message_info:
-            geolocation_keys = self.redis_conn.keys("geohash_tree:*")
-            for geo_key in geolocation_keys:
-                geohash_2 = geo_key.decode("utf-8").replace("geohash_tree:", "")
-                #print(f"Target geohash => {geohash_2}")
-                #Remember to exclude all geohashes outside of 200
-                for outer_radius in range(20, 200, 20):
-                    users = self.within_bounds(outer_radius - 20, outer_radius, geohash, geohash_2, geo_key)
-                    if users:
-                        #print(f"Bounds {outer_radius - 20} - {outer_radius} has {len(users)} users @ geohash_2")
-                        for devid in users:
-                            print(f"Sending {message_info['message_id']} to {devid}")
-                            await self.send_message(message_info, devid, source_id)
-
-    async def send_message(self, message_info, device_id, source_id):
-        if message_info and device_id in self.active_connections and source_id != device_id:
-            self.active_connections[device_id]
-            message_id = message_info['message_id']
-            websocket = self.active_connections.get(device_id)
-            if websocket:
-                decoded_message_data = {key: value if isinstance(value, bytes) else value for key, value in message_info.items()}
-                await websocket.send(json.dumps(decoded_message_data))
-                print(f"Sent message with message_id {message_id} to device {device_id}")
+            # Only cells that currently hold devices and lie within the outermost annulus are candidates.
+            # Redis measures on a sphere, so the search is widened by the haversine error and compute_bands,
+            # which measures cells near the edge exactly, leaves out those really beyond it
+            search_radius_km = MAX_PROPAGATION_KM * (1 + HAVERSINE_TOLERANCE) + 0.01
+            cells, lats, lons = await self.geo_tree.get_cell_centers_within_radius(geohash, search_radius_km)
+            bands = await self.compute_pool.run(compute_bands, geohash, lats, lons) if cells else []
+
+            targets = [(geohash_2, band * BAND_WIDTH_KM) for geohash_2, band in zip(cells, bands) if band >= 0]
+            users = await self.sample_users(targets)
+            FANOUT.observe(len(users))
+            #print(f"Propagating to {len(users)} users in {len(targets)} cells")
+            # Encoded once for every recipient
+            payload = relay_messages.encode(message_info)
+            delivered = await self.route(payload, users, source_id)
+            logger.debug("Sent message with message_id %s to %d of %d devices", message_info['message_id'], delivered, len(users))
+
+    async def route(self, payload, device_ids, source_id):
+        # Devices on this worker are sent to directly; the rest are published to the worker that owns them
+        recipients = set(device_ids)
+        recipients.discard(source_id)
+        local_ids = [device_id for device_id in recipients if device_id in self.active_connections]
+        remote_ids = [device_id for device_id in recipients if device_id not in self.active_connections]
+
+        published = 0
+        if remote_ids:
+            owners = await self.redis_conn.hmget(DEVICE_WORKERS_KEY, remote_ids)
+            deliveries = {}
+            for device_id, owner in zip(remote_ids, owners):
+                if owner is not None and owner.decode("utf-8") != self.worker_id:
+                    deliveries.setdefault(owner.decode("utf-8"), []).append(device_id)
+            if deliveries:
+                async with self.redis_conn.pipeline(transaction=False) as pipe:
+                    for worker_id, worker_device_ids in deliveries.items():
+                        # Header line of device ids, then the payload untouched so it is not escaped again
+                        pipe.publish(f"{DELIVERY_CHANNEL_PREFIX}{worker_id}", relay_messages.encode(worker_device_ids) + "\n" + payload)
+                    await pipe.execute()
+                published = sum(len(worker_device_ids) for worker_device_ids in deliveries.values())
+
+        return await self.deliver(payload, local_ids, source_id) + published
+
+    async def receive_deliveries(self):
+        # Runs for the life of the worker; a lost subscription is made again after a backoff
+        retry_seconds = RETRY_INITIAL_SECONDS
+        while True:
+            pubsub = self.redis_conn.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(f"{DELIVERY_CHANNEL_PREFIX}{self.worker_id}")
+                retry_seconds = RETRY_INITIAL_SECONDS
+                async for message in pubsub.listen():
+                    try:
+                        header, payload = message['data'].decode("utf-8").split("\n", 1)
+                        device_ids = relay_messages.device_ids_decoder.decode(header)
+                    except (ValueError, relay_messages.DecodeError) as e:
+                        logger.warning("Discarding invalid delivery: %s", e)
+                        continue
+                    # Each delivery runs on its own so a slow one never holds up the subscription
+                    task = asyncio.create_task(self.deliver(payload, device_ids, None))
+                    self.delivery_tasks.add(task)
+                    task.add_done_callback(self.delivery_tasks.discard)
+            except Exception as e:
+                logger.exception("Delivery subscription failed, subscribing again in %ds: %s", retry_seconds, e)
+            finally:
+                await pubsub.aclose()
+            await asyncio.sleep(retry_seconds)
+            retry_seconds = min(retry_seconds * 2, RETRY_MAX_SECONDS)
+
+    async def deliver(self, payload, device_ids, source_id):
+        # Send one encoded payload to many devices concurrently; returns how many sends succeeded
+        semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+        recipients = set(device_ids)
+        recipients.discard(source_id)
+        results = await asyncio.gather(*[self.send_payload(payload, device_id, semaphore) for device_id in recipients])
+        return sum(results)
+
+    async def send_payload(self, payload, device_id, semaphore):
+        websocket = self.active_connections.get(device_id)
+        if websocket is None:
+            DELIVERIES.labels("missing").inc()
+            return False
+
+        # A device that has not drained what it was already sent gets nothing more
+        transport = websocket.transport
+        if transport is not None:
+            queued = transport.get_write_buffer_size()
+            SEND_QUEUE_BYTES.observe(queued)
+            if queued > SEND_QUEUE_LIMIT:
+                DELIVERIES.labels("queue_full").inc()
+                logger.debug("Skipping device %s: send queue full", device_id)
+                return False
+
+        async with semaphore:
+            try:
+                await asyncio.wait_for(websocket.send(payload), SEND_TIMEOUT_SECONDS)
+                DELIVERIES.labels("sent").inc()
+                return True
+            except asyncio.TimeoutError:
+                # A send cancelled mid-frame leaves the connection unusable, so the slow consumer is dropped
+                DELIVERIES.labels("timeout").inc()
+                logger.info("Dropping slow device %s", device_id)
+                if transport is not None:
+                    transport.abort()
+            except websockets.exceptions.ConnectionClosed:
+                DELIVERIES.labels("closed").inc()
+                logger.debug("Device %s not connected.", device_id)
+        return False
+
+    async def remove_expired_messages(self, batch_size=EXPIRY_BATCH_SIZE):
+        # Unindex one batch of expired incidents; returns how many were removed
+        current_time = datetime.now().timestamp()
+        expired_message_ids = await self.redis_conn.zrangebyscore(INCIDENT_EXPIRY_KEY, '-inf', current_time, start=0, num=batch_size)
+        if not expired_message_ids:
+            return 0
+
+        async with self.redis_conn.pipeline() as pipe:
+            pipe.zrem(INCIDENT_EXPIRY_KEY, *expired_message_ids)
+            pipe.zrem(INCIDENT_TIME_KEY, *expired_message_ids)
+            pipe.zrem(INCIDENT_LOCATION_KEY, *expired_message_ids)
+            # Normally already gone through their own TTL
+            pipe.delete(*[f"{prefix}:{message_id.decode('utf-8')}" for message_id in expired_message_ids for prefix in ("message", "message_vector")])
+            await pipe.execute()
+        return len(expired_message_ids)
+
+    async def expire_incidents(self):
+        while True:
+            try:
+                removed = await self.remove_expired_messages()
+            except Exception as e:
+                # A failed sweep is retried on the next interval rather than taking the worker down
+                logger.exception("Expiry sweep failed: %s", e)
+                removed = 0
+            if removed:
+                logger.info("Removed %d expired message%s.", removed, 's' if removed > 1 else '')
+                # Keep draining the backlog, but let the relay run between batches
+                await asyncio.sleep(0)
             else:
-                print(f"Device {device_id} not connected.")
-        else:
-            print(f"Wrong message or connection not found for device {device_id}.")
+                await asyncio.sleep(EXPIRY_INTERVAL_SECONDS)
 
-    def remove_expired_messages(self):
-        current_time = datetime.now()
-        expired_message_ids = []
-        
-        for message_key in self.redis_conn.keys("message:*"):  # Use message keys
-            #print(f"message_key={message_key}")
-            message_info = json.loads(self.redis_conn.get(message_key) or '{}')
-            #print(f"message_info={message_info}")
+    async def rebuild_expiry_index(self):
+        # Give incidents stored without a TTL one, and index them for the expiry sweep
+        async for message_key in self.redis_conn.scan_iter("message:*"):
+            if await self.redis_conn.ttl(message_key) != -1:
+                continue
+            message_info = json.loads(await self.redis_conn.get(message_key) or '{}')
+            message_id = message_key.decode("utf-8").replace("message:", "")
             try:
                 expiration_time = datetime.strptime(message_info['expiration_time'], '%Y-%m-%d %H:%M:%S')
-                #print(f"expiration_time={expiration_time}")
-                if expiration_time <= current_time:
-                    self.redis_conn.delete(message_key)
-                    expired_message_ids.append(message_key)
             except KeyError:
                 # Handle the case where 'expiration_time' key is missing
-                print(f"Expiration time not found for message with id {message_key}. Skipping.")
-        if 1 > len(expired_message_ids):
-            print(f"Removed {len(expired_message_ids)} expired messages.")
-        else:
-            print(f"Removed {len(expired_message_ids)} expired message.")
+                logger.warning("Expiration time not found for message with id %s. Skipping.", message_key)
+                continue
+            await self.redis_conn.expireat(message_key, int(expiration_time.timestamp()))
+            await self.redis_conn.zadd(INCIDENT_EXPIRY_KEY, {message_id: expiration_time.timestamp()})
+
+    async def run_migrations(self, migrations):
+        # Each (name, migration) is applied once per Redis database; a failed one is tried again on the next start
+        for name, migration in migrations:
+            if await self.redis_conn.sismember(MIGRATIONS_KEY, name):
+                continue
+            try:
+                await migration()
+            except Exception as e:
+                logger.exception("Migration %s failed: %s", name, e)
+                continue
+            await self.redis_conn.sadd(MIGRATIONS_KEY, name)
+            logger.info("Applied migration %s", name)
 
     def classify_incident(self, text):
         try:
             incident_label = self.incident_classifier.predict(text)
             return incident_label
         except Exception as e:
-            print(f"An error occurred during incident classification: {str(e)}")
+            logger.exception("An error occurred during incident classification: %s", e)
             return "UNKNOWN"                
 
 class GeoHashTree:
-    def __init__(self):
-        self.redis_conn = redis.StrictRedis(host='localhost', port=6379, db=0)
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+        # Compute processes only use the distance helpers and have no connection
+        if redis_conn is not None:
+            self.remove_member_script = self.redis_conn.register_script(REMOVE_MEMBER_SCRIPT)
+            self.move_member_script = self.redis_conn.register_script(MOVE_MEMBER_SCRIPT)
  
     def calculate_distance(self, geohash_1, geohash_2):
         lat1, lon1 = geohash2.decode(geohash_1)
@@ -295,45 +785,92 @@ class GeoHashTree:
         return geodesic((lat1, lon1), (lat2, lon2)).kilometers
 
     async def insert_user(self, user_data):
-        geohash = user_data['geohash']
-        device_id = user_data['device_id']
-        location_key = f"geohash_tree:{geohash}"
-        users_set = set(json.loads(self.redis_conn.hget(location_key, 'users') or '[]'))
-        users_set.add(device_id)
-        user_key = f"user:{device_id}"
-        
-        self.redis_conn.hset(location_key, 'users', json.dumps(list(users_set)))
-        self.redis_conn.set(user_key, json.dumps(user_data))
+        # A device re-registering from another cell leaves its previous cell in the same step
+        await self.move_user(user_data['device_id'], user_data['geohash'], force=True)
+
+    async def move_user(self, device_id, geohash, force=False):
+        # Returns False when the device was already in the cell of geohash and nothing was written
+        cell = geohash[:INDEX_PRECISION]
+        lat, lon = geohash2.decode(cell)
+        user_data = {'device_id': device_id, 'geohash': geohash, 'cell': cell}
+        moved = await self.move_member_script(
+            keys=[f"user:{device_id}", GEOHASH_INDEX_KEY],
+            args=[device_id, cell, float(lon), float(lat), json.dumps(user_data), '1' if force else '0']
+        )
+        return bool(moved)
 
     async def remove_user(self, device_id):
         user_key = f"user:{device_id}"
         
-        user_data = json.loads(self.redis_conn.get(user_key) or '{}')
-        geohash = user_data.get('geohash', None)
-
-        geolocation_keys = self.redis_conn.keys("geohash_tree:*")
-        for geo_key in geolocation_keys:
-            geohash_2 = geo_key.decode("utf-8").replace("geohash_tree:", "")       
-            #TODO Remove all occurrences of device_id in all geohash_tree:{geohash} users
-            location_key = f"geohash_tree:{geohash_2}"
-            users_set = json.loads(self.redis_conn.hget(location_key, 'users') or '[]')
-            if device_id in users_set:
-                users_set.remove(device_id)
-            
-            self.redis_conn.hset(location_key, 'users', json.dumps(users_set))
+        user_data = json.loads(await self.redis_conn.get(user_key) or '{}')
+        # Records written before cells were truncated to INDEX_PRECISION name the cell by its geohash
+        cell = user_data.get('cell', user_data.get('geohash', None))
+
+        # The user record holds the only cell the device was placed in
+        if cell:
+            await self.remove_from_cell(device_id, cell)
         
-        self.redis_conn.delete(user_key)
+        await self.redis_conn.delete(user_key)
+
+    async def remove_from_cell(self, device_id, geohash):
+        # Empty cells leave the spatial index so fan-out queries never visit them
+        await self.remove_member_script(keys=[f"geohash_users:{geohash}", GEOHASH_INDEX_KEY], args=[device_id, geohash])
+
+    async def get_cell_users(self, geohash):
+        users = await self.redis_conn.smembers(f"geohash_users:{geohash}")
+        return [user.decode("utf-8") for user in users]
 
+    async def count_cell_users(self, geohashes):
+        async with self.redis_conn.pipeline(transaction=False) as pipe:
+            for geohash in geohashes:
+                pipe.scard(f"geohash_users:{geohash}")
+            return await pipe.execute()
 
-    def get_users_within_radius(self, geohash, geohash_2, radius):
+    async def sample_cell_users(self, samples):
+        # samples holds (geohash, count) pairs; returns the union of SRANDMEMBER over all of them
+        async with self.redis_conn.pipeline(transaction=False) as pipe:
+            for geohash, count in samples:
+                pipe.srandmember(f"geohash_users:{geohash}", count)
+            results = await pipe.execute()
+        return [user.decode("utf-8") for users in results for user in users]
+
+    async def rebuild_index(self):
+        # Cells written as JSON lists in geohash_tree:{geohash} hold devices of sockets that closed with the relay
+        # that wrote them, so they are dropped with their user records rather than carried into membership sets
+        async for geo_key in self.redis_conn.scan_iter("geohash_tree:*"):
+            for device_id in json.loads(await self.redis_conn.hget(geo_key, 'users') or '[]'):
+                # A device that has registered again since is owned by a worker and left alone
+                if not await self.redis_conn.hexists(DEVICE_WORKERS_KEY, device_id):
+                    await self.remove_user(device_id)
+            await self.redis_conn.delete(geo_key)
+
+        # Backfill the spatial index for cells written before it existed
+        async for location_key in self.redis_conn.scan_iter("geohash_users:*"):
+            geohash = location_key.decode("utf-8").replace("geohash_users:", "")
+            lat, lon = geohash2.decode(geohash)
+            await self.redis_conn.geoadd(GEOHASH_INDEX_KEY, (float(lon), float(lat), geohash))
+
+    async def get_cell_centers_within_radius(self, geohash, radius_km):
+        # The index stores each cell's center, so the coordinates come back with the search itself
+        lat, lon = geohash2.decode(geohash)
+        results = await self.redis_conn.geosearch(GEOHASH_INDEX_KEY, longitude=float(lon), latitude=float(lat), radius=radius_km, unit='km', withcoord=True)
+        cells = [cell.decode("utf-8") for cell, _ in results]
+        coords = np.array([coord for _, coord in results], dtype=np.float64).reshape(-1, 2)
+        return cells, coords[:, 1], coords[:, 0]
+
+    def decode_cells(self, geohashes):
+        centers = np.array([geohash2.decode(geohash) for geohash in geohashes], dtype=np.float64).reshape(-1, 2)
+        return centers[:, 0], centers[:, 1]
+
+    async def get_users_within_radius(self, geohash, geohash_2, radius):
         users_within_radius = []
-        self.traverse_tree(geohash, geohash_2, users_within_radius, radius)
+        await self.traverse_tree(geohash, geohash_2, users_within_radius, radius)
         return users_within_radius
 
-    def get_users_within_annulus(self, geohash, outer_radius, inner_users):
+    async def get_users_within_annulus(self, geohash, outer_radius, inner_users):
         effective_users = []
         inner_radius = outer_radius - 3
-        outer_users = self.get_users_within_radius(geohash, outer_radius)
+        outer_users = await self.get_users_within_radius(geohash, outer_radius)
         ##TODO Should be fetching the location geohashes which contain the users
         # No need to fetch inner_users as they start as empty and outer_users becomes inner_users
         # on next iteration
@@ -357,8 +894,7 @@ class GeoHashTree:
         
         return attenuation
 
-    def traverse_tree(self, geohash, geohash_2, users_within_radius, radius):
-        node_key = "geohash_tree:" + geohash_2
+    async def traverse_tree(self, geohash, geohash_2, users_within_radius, radius):
         # Get the center latitude and longitude of the current geohash
         center_lat, center_lon = geohash2.decode(geohash)
         lat, lon = geohash2.decode(geohash)
@@ -368,7 +904,7 @@ class GeoHashTree:
         
         # If the distance is within the radius, add the geohash to users_within_radius
         if distance <= radius:
-            users_data = json.loads(self.redis_conn.hget(node_key, 'users') or '[]')
+            users_data = await self.get_cell_users(geohash_2)
             users_within_radius.append(users_data)
 
     def haversine_distance(self, lat1, lon1, lat2, lon2):
@@ -380,73 +916,176 @@ class GeoHashTree:
         c = 2 * atan2(sqrt(a), sqrt(1 - a))
         distance = 6371 * c
         return distance
-        
+
+    def haversine_distances(self, lat, lon, lats, lons):
+        # Vectorized haversine_distance from one origin to arrays of float64 coordinates
+        lat, lon = radians(float(lat)), radians(float(lon))
+        lats, lons = np.radians(lats), np.radians(lons)
+        a = np.sin((lats - lat) / 2) ** 2 + cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+        return 6371 * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    def batch_distances(self, geohash, lats, lons, boundaries=None):
+        """
+        Distances in kilometers from the center of geohash to every (lats[i], lons[i]).
+        Distances within the haversine error of one of the given boundaries are recomputed exactly
+        with geodesic, so callers comparing against those boundaries get the same answer as calculate_distance.
+        """
+        lat, lon = geohash2.decode(geohash)
+        distances = self.haversine_distances(lat, lon, lats, lons)
+        if boundaries is not None and distances.size:
+            boundaries = np.asarray(boundaries, dtype=np.float64)
+            margin = np.abs(distances[:, None] - boundaries[None, :]).min(axis=1)
+            for i in np.flatnonzero(margin <= distances * HAVERSINE_TOLERANCE + 0.01):
+                distances[i] = geodesic((lat, lon), (lats[i], lons[i])).kilometers
+        return distances
+
+class SimilarityEngine:
+    def __init__(self, n_features=SIMILARITY_FEATURES):
+        # Stateless hashing keeps vectors comparable across incidents without refitting a vocabulary;
+        # rows are L2-normalised so a dot product is the cosine similarity
+        self.vectorizer = HashingVectorizer(n_features=n_features, alternate_sign=False, norm='l2')
+        self.n_features = n_features
+
+    def vectorize(self, text):
+        return self.vectorizer.transform([text])
+
+    def serialize(self, vector):
+        return vector.indices.astype('<i4').tobytes() + vector.data.astype('<f4').tobytes()
+
+    def deserialize(self, value):
+        size = len(value) // 8
+        indices = np.frombuffer(value, dtype='<i4', count=size)
+        data = np.frombuffer(value, dtype='<f4', offset=size * 4, count=size).astype(np.float64)
+        return csr_matrix((data, indices, [0, size]), shape=(1, self.n_features))
+
+    def score(self, vector, vectors):
+        if not vectors:
+            return []
+        return (vstack(vectors, format='csr') @ vector.T).toarray().ravel().tolist()
+
 relay_server = RelayServer()        
 
+async def handle_register(websocket, message):
+    logger.debug("handle_connection - register %s %s", message.device_id, message.geohash)
+    await relay_server.register(websocket, message.device_id, message.geohash)
+
+async def handle_broadcast(websocket, message):
+    logger.debug("handle_connection - broadcast %s %s", message.device_id, message.geohash)
+    # The image string is handed straight to the blob store
+    await relay_server.broadcast(websocket, message.device_id, message.geohash, message.message, message.base64_image or "")
+
+async def handle_rebroadcast(websocket, message):
+    logger.debug("handle_connection - rebroadcast %s %s", message.device_id, message.geohash)
+    await relay_server.rebroadcast(websocket, message.device_id, message.geohash, message.message_id)
+
+async def handle_update_location(websocket, message):
+    logger.debug("handle_connection - update_location %s %s=>%s", message.device_id, message.old_geohash, message.new_geohash)
+    await relay_server.update_location(websocket, message.device_id, message.old_geohash, message.new_geohash)
+
+async def handle_fetch_image(websocket, message):
+    await relay_server.fetch_image(websocket, message.image_id)
+
+MESSAGE_HANDLERS = {
+    Register: handle_register,
+    Broadcast: handle_broadcast,
+    Rebroadcast: handle_rebroadcast,
+    UpdateLocation: handle_update_location,
+    FetchImage: handle_fetch_image,
+}
+
 # WebSocket handler
 async def handle_connection(websocket, path):
+    CONNECTIONS.inc()
     try:
-        async for message in websocket:
-            data = {}
-            base64_image_start = message.find('"base64_image":')
-            base64_image = ''
-            if base64_image_start != -1:
-                base64_image_start += len('"base64_image":') + 1
-                base64_image_end = message.find('"', base64_image_start)  # Find the first occurrence
-                base64_image_start = message.find('"', base64_image_start) + 1  # Find the start of the image data
-                base64_image_end = message.find('"', base64_image_start)  # Find the second occurrence
-                base64_image = message[base64_image_start:base64_image_end]
-                message = message[:base64_image_start - 1] + message[base64_image_end + 1:]
-                base64_image_index = message.find('"base64_image":')
-                if base64_image_index != -1:
-                    message = message[:base64_image_index] + '"base64_image": ""}'
-            try:
-                data = json.loads(message)
-            except json.JSONDecodeError as e:
-                print("Error decoding JSON:", e)
-                continue
-            if data["action"] == "register":
-                print(f"handle_connection - register {data['device_id']} {data['geohash']}")
-                await relay_server.register(websocket, data["device_id"], data["geohash"])
-            elif data["action"] == "broadcast":
-                print(f"handle_connection - broadcast {data['device_id']} {data['geohash']}")
-                await relay_server.broadcast(websocket, data["device_id"], data["geohash"], data["message"], base64_image)
-            elif data["action"] == "rebroadcast":
-                print(f"handle_connection - rebroadcast {data['device_id']} {data['geohash']}")
-                await relay_server.rebroadcast(websocket, data["device_id"], data["geohash"], data["message_id"])
-            elif data["action"] == "update_location":
-                print(f"handle_connection - update_location {data['device_id']} {data['old_geohash']}=>{data['new_geohash']}")
-                await relay_server.update_location(data["device_id"], data["old_geohash"], data["new_geohash"])
-    except websockets.exceptions.ConnectionClosedError:
+        async for frame in websocket:
+            await relay_messages.dispatch(websocket, frame, relay_messages.buzzr_decoder, MESSAGE_HANDLERS, MESSAGES, logger)
+    except websockets.exceptions.ConnectionClosed:
         pass
+    finally:
+        CONNECTIONS.dec()
+        await relay_server.disconnect(websocket)
 
 # Start WebSocket server
-async def main():
+async def main(worker_index, options):
     key_file_path = "/home/niyid/workspace/buzzr.key"
     crt_file_path = "/home/niyid/workspace/buzzr.crt"
 
-    try:
-        with open(key_file_path, "rb") as key_file:
-            private_key = serialization.load_pem_private_key(
-                key_file.read(),
-                password=b'',  # Replace 'your_passphrase_here' with your passphrase
-                backend=default_backend()
-            )
-
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        ssl_context.load_cert_chain(crt_file_path, keyfile=key_file_path, password="")
-        print("Certificate and key loaded successfully from:", key_file_path)
-
-    except FileNotFoundError:
-        print("Error: File not found at path:", key_file_path)
-    except Exception as e:
-        print("An error occurred:", e)
+    # Plain ws:// when insecure, for local testing and benchmarks
+    ssl_context = None
+    if not options.insecure:
+        try:
+            with open(key_file_path, "rb") as key_file:
+                private_key = serialization.load_pem_private_key(
+                    key_file.read(),
+                    password=b'',  # Replace 'your_passphrase_here' with your passphrase
+                    backend=default_backend()
+                )
+
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ssl_context.load_cert_chain(crt_file_path, keyfile=key_file_path, password="")
+            logger.info("Certificate and key loaded successfully from: %s", key_file_path)
+
+        except FileNotFoundError:
+            logger.error("Error: File not found at path: %s", key_file_path)
+            raise SystemExit(1)
+        except Exception as e:
+            logger.error("An error occurred: %s", e)
+            # Only --insecure serves plain ws://; a relay that cannot load its certificate does not start
+            raise SystemExit(1)
     
-    async with websockets.serve(handle_connection, "0.0.0.0", 7071, ssl=ssl_context):
-            print(f"Server running on port 7071")
-            while True:
-                # Run remove_expired_messages() every 2 days
-                relay_server.remove_expired_messages()
-                await asyncio.sleep(2 * 24 * 3600)
-
-asyncio.run(main())
+    delivery_task = asyncio.create_task(relay_server.receive_deliveries())
+    # The first worker also releases devices left behind by workers that died
+    reconcile_task = asyncio.create_task(relay_server.reconcile(clean_up_workers=worker_index == 0))
+
+    # Several workers bind the same port and the kernel spreads new connections across them; a single
+    # worker binds it exclusively, so a second relay started on the same port fails instead of sharing it
+    async with websockets.serve(handle_connection, "0.0.0.0", options.port, ssl=ssl_context, reuse_port=options.workers > 1,
+                                ping_interval=options.heartbeat_interval, ping_timeout=options.idle_timeout):
+            logger.info("Worker %s running on port %d", relay_server.worker_id, options.port)
+            # Shared Redis state is maintained by the first worker only
+            if worker_index == 0:
+                # Data stored by older versions is brought up to date once, in the background rather than before serving
+                migration_task = asyncio.create_task(relay_server.run_migrations([
+                    ("geohash_index", relay_server.geo_tree.rebuild_index),
+                    ("incident_expiry_index", relay_server.rebuild_expiry_index),
+                ]))
+                # Expired incidents are unindexed in small batches alongside normal traffic
+                await relay_server.expire_incidents()
+            else:
+                await asyncio.Future()
+
+def run_worker(worker_index, options):
+    # Forked workers must not share the parent's identity
+    relay_server.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    configure_logging(options.log_level)
+    if options.metrics_port:
+        start_metrics_server(options.metrics_port + worker_index)
+    relay_server.connect_redis(options.redis_host, options.redis_port, options.redis_db)
+    relay_server.compute_pool.start(options.compute_workers)
+    asyncio.run(main(worker_index, options))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Buzzr relay server")
+    parser.add_argument("--port", type=int, default=7071, help="websocket port")
+    parser.add_argument("--insecure", action="store_true", help="serve plain ws:// without the TLS certificate")
+    parser.add_argument("--workers", type=int, default=1, help="number of relay worker processes")
+    parser.add_argument("--compute-workers", type=int, default=COMPUTE_WORKERS, help="CPU-bound broadcast processes per relay worker, 0 to run inline")
+    parser.add_argument("--heartbeat-interval", type=float, default=HEARTBEAT_INTERVAL_SECONDS, help="seconds between pings to each device")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT_SECONDS, help="seconds without a pong before a device is disconnected")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="local HTTP port for metrics of the first worker, the next ones use the following ports; 0 disables")
+    parser.add_argument("--redis-host", default=REDIS_HOST)
+    parser.add_argument("--redis-port", type=int, default=REDIS_PORT)
+    parser.add_argument("--redis-db", type=int, default=REDIS_DB)
+    parser.add_argument("--log-level", default="INFO", help="DEBUG logs every message and delivery, WARNING keeps only problems")
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        run_worker(0, args)
+    else:
+        workers = [multiprocessing.Process(target=run_worker, args=(worker_index, args)) for worker_index in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if any(worker.exitcode for worker in workers):
+            raise SystemExit(1)
@@ -1,40 +1,187 @@
 import asyncio
 import websockets
-import json
 import ssl
 import os
 import base64
+import hashlib
+import logging
+import mmap
+import struct
+from collections import OrderedDict
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from datetime import datetime, timedelta
 import pymupdf  # PyMuPDF
+from pdf_paragraphs import page_paragraphs, page_html_and_paragraphs
+import relay_messages
+from relay_messages import CoreaderRegister, CoreaderUnregister, Ready, UploadChunk, UploadStart, UploadComplete, ListSessions
+from relay_metrics import Counter, Gauge, Histogram, SIZE_BUCKETS, configure_logging, start_metrics_server
+from relay_workers import WorkerPool
 
 BASE_PDF_PATH = "/home/niyid/workspace/pdf"
+# Uploads are written here as they arrive and renamed to the session's PDF when complete
+PARTIAL_UPLOAD_SUFFIX = ".part"
+# Processes doing PDF work (0 runs it inline), and how long a reader waits for one job
+PDF_WORKERS = int(os.environ.get("COREADER_PDF_WORKERS", os.cpu_count() or 1))
+PDF_TIMEOUT_SECONDS = 30
+# Open PDFs kept by each process, bounded by count and by the size of their files
+DOCUMENT_CACHE_HANDLES = 32
+DOCUMENT_CACHE_BYTES = 512 * 1024 * 1024
+# Pages extracted ahead of the one being read
+PREFETCH_PAGES = 3
+# Uploaded PDFs are stored once under BASE_PDF_PATH in this directory, named by the SHA-256 of their content,
+# next to the extracted content of every page
+LIBRARY_DIR = "library"
+EXTRACTION_SUFFIX = ".pages"
+EXTRACTION_MAGIC = b"CRDPAGE1"
+# Magic and page count, then per page the offset and length of its HTML and of its paragraph list
+EXTRACTION_HEADER = struct.Struct(">8sI")
+EXTRACTION_ENTRY = struct.Struct(">QIQI")
+METRICS_PORT = 9181
+
+logger = logging.getLogger("coreader")
+
+CONNECTIONS = Gauge("coreader_connections", "Open reader websockets")
+MESSAGES = Counter("coreader_messages", "Messages received from readers", ["type"])
+SESSIONS = Gauge("coreader_sessions", "Reading sessions with at least one peer")
+UPLOAD_BYTES = Counter("coreader_upload_bytes", "PDF bytes received by uploads")
+PDF_SECONDS = Histogram("coreader_pdf_seconds", "Time PDF jobs take including the pool queue", ["operation"])
+PDF_TIMEOUTS = Counter("coreader_pdf_timeouts", "PDF jobs abandoned after PDF_TIMEOUT_SECONDS", ["operation"])
+FANOUT = Histogram("coreader_notify_peers", "Peers sent one session update", buckets=SIZE_BUCKETS)
+DOCUMENT_CACHE = Counter("coreader_document_cache", "Open-document cache lookups by result", ["result"])
+CONTENT_CACHE = Counter("coreader_content_cache", "Page content requests by whether extraction had already finished", ["result"])
+LIBRARY_UPLOADS = Counter("coreader_library_uploads", "Completed uploads by whether the same PDF was already stored", ["result"])
+
+class DocumentCache:
+    def __init__(self, max_handles=DOCUMENT_CACHE_HANDLES, max_bytes=DOCUMENT_CACHE_BYTES):
+        self.max_handles = max_handles
+        self.max_bytes = max_bytes
+        # PDF path -> (document, file size), least recently used first; sessions reading the same file share it
+        self.documents = OrderedDict()
+        self.total_bytes = 0
+
+    def get(self, pdf_path):
+        entry = self.documents.get(pdf_path)
+        if entry is not None:
+            DOCUMENT_CACHE.labels("hit").inc()
+            self.documents.move_to_end(pdf_path)
+            return entry[0]
+
+        DOCUMENT_CACHE.labels("miss").inc()
+        doc = pymupdf.open(pdf_path)
+        # The file size stands in for the memory a parsed document holds
+        size = os.path.getsize(pdf_path)
+        self.documents[pdf_path] = (doc, size)
+        self.total_bytes += size
+        # The document just opened is kept even when it alone exceeds the budget
+        while len(self.documents) > 1 and (len(self.documents) > self.max_handles or self.total_bytes > self.max_bytes):
+            self.close(next(iter(self.documents)))
+        return doc
+
+    def close(self, pdf_path):
+        entry = self.documents.pop(pdf_path, None)
+        if entry is not None:
+            doc, size = entry
+            self.total_bytes -= size
+            doc.close()
+
+
+class ExtractionStore:
+    # Extracted content of one PDF, read from a memory-mapped file written by write_extraction
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.page_count = EXTRACTION_HEADER.unpack_from(self.mmap, 0)
+        if magic != EXTRACTION_MAGIC:
+            self.mmap.close()
+            raise ValueError(f"{path} is not an extraction file")
+        self.index = [EXTRACTION_ENTRY.unpack_from(self.mmap, EXTRACTION_HEADER.size + page_index * EXTRACTION_ENTRY.size)
+                      for page_index in range(self.page_count)]
+
+    def entry(self, page_index):
+        if not 0 <= page_index < self.page_count:
+            raise IndexError(f"page index {page_index} not in document")
+        return self.index[page_index]
+
+    def page_html(self, page_index):
+        offset, length, _, _ = self.entry(page_index)
+        return self.mmap[offset:offset + length].decode("utf-8")
+
+    def paragraphs(self, page_index):
+        _, _, offset, length = self.entry(page_index)
+        return relay_messages.paragraphs_decoder.decode(self.mmap[offset:offset + length])
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Open documents of this process; each PDF worker process keeps its own
+pdf_documents = DocumentCache()
+
+
+def start_pdf_worker(worker_count):
+    # Handles in a worker outlive the sessions that opened them until its LRU evicts them, as the server cannot
+    # reach a particular worker to close one; the workers share one budget so together they hold no more than
+    # a single process would
+    global pdf_documents
+    pdf_documents = DocumentCache(max(DOCUMENT_CACHE_HANDLES // worker_count, 1), DOCUMENT_CACHE_BYTES // worker_count)
+
+
+def pdf_page_count(pdf_path):
+    return pdf_documents.get(pdf_path).page_count
+
+
+def pdf_page_html(pdf_path, page_number):
+    page = pdf_documents.get(pdf_path).load_page(page_number - 1)  # Page numbers are zero-based
+    return page.get_text("html")
+
+
+def pdf_page_paragraphs(pdf_path, page_number, spacing_threshold=10, font_size_threshold=14, header_y_threshold=100, min_paragraph_length=20):
+    page = pdf_documents.get(pdf_path).load_page(page_number)
+    return page_paragraphs(page, spacing_threshold, font_size_threshold, header_y_threshold, min_paragraph_length)
+
+
+def pdf_page_content(pdf_path, page_index):
+    return page_html_and_paragraphs(pdf_documents.get(pdf_path).load_page(page_index))
+
 
 class RelayServer:
     def __init__(self):
         self.sessions = {}
         self.clients = {}
+        # A large book occupies one worker while the loop keeps serving every other session
+        self.pdf_pool = WorkerPool(PDF_WORKERS, PDF_SECONDS, timeout=PDF_TIMEOUT_SECONDS, timeouts=PDF_TIMEOUTS, initializer=start_pdf_worker)
+        self.background_tasks = set()
+        # Content hash -> ExtractionStore, and the builds still running
+        self.extractions = {}
+        self.extraction_builds = {}
 
     async def register(self, websocket, device_id, session_id, title):
-        print(f"register {device_id} {session_id} {title}")
+        logger.debug("register %s %s %s", device_id, session_id, title)
         if session_id not in self.sessions:
+            SESSIONS.inc()
             self.sessions[session_id] = {
                 'title': title,
                 'peers': {},
                 'current_page': 0,
                 'current_paragraph': 0,
-                'file_chunks': {}
+                'upload': None,
+                'content': {}
             }
         self.sessions[session_id]['peers'][device_id] = {'websocket': websocket, 'ready': False}
         self.clients[websocket] = {'device_id': device_id, 'session_id': session_id}
           
-        message = json.dumps({
+        message = relay_messages.encode({
             'type': 'create_session_response',
             'session_id': session_id,
             'title': title
         })
-        print(f"register - {message}")
+        logger.debug("register - %s", message)
         
         await websocket.send(message)
 
@@ -45,65 +192,342 @@ class RelayServer:
             del self.clients[websocket]
             del self.sessions[session_id]['peers'][device_id]
             if not self.sessions[session_id]['peers']:
-                del self.sessions[session_id]
+                # A partial upload stays on disk so it can be resumed
+                session = self.sessions.pop(session_id)
+                SESSIONS.dec()
+                self.close_upload(session)
+                # Nobody is left to read what is still queued for the session
+                self.cancel_content(session)
+                self.release_document(session.get('pdf_path') or f"{BASE_PDF_PATH}/{session_id}.pdf", session.get('content_hash'))
             else:
                 await self.notify_peers(session_id)
 
     async def handle_ready(self, websocket, device_id, session_id, ready):
-        self.sessions[session_id]['peers'][device_id]['ready'] = ready
-        if all(peer['ready'] for peer in self.sessions[session_id]['peers'].values()):
-            await self.notify_page_turn(session_id)
-            # Reset the 'ready' flags for all peers after the paragraph turn
-            for peer in self.sessions[session_id]['peers'].values():
-                peer['ready'] = False
+        session = self.sessions[session_id]
+        session['peers'][device_id]['ready'] = ready
+        if all(peer['ready'] for peer in session['peers'].values()):
+            try:
+                await self.notify_page_turn(session_id)
+            finally:
+                # Reset the 'ready' flags for all peers after the paragraph turn, including a failed one,
+                # so the next round of ready frames tries it again
+                for peer in session['peers'].values():
+                    peer['ready'] = False
 
 
     async def notify_peers(self, session_id):
         #print(f"notify_peers {session_id}")
         session = self.sessions[session_id]
-        message = json.dumps({
+        message = relay_messages.encode({
             'type': 'peer_update',
             'count': len(session['peers'])
         })
-        await asyncio.gather(*[peer['websocket'].send(message) for peer in session['peers'].values()])
+        await self.send_to_peers(session, message)
+
+    async def send_to_peers(self, session, message_json):
+        # A peer whose socket has gone is dropped by its own connection handler, not by the sender's
+        FANOUT.observe(len(session['peers']))
+        await asyncio.gather(*[peer['websocket'].send(message_json) for peer in list(session['peers'].values())], return_exceptions=True)
+
+    async def notify_turn_failed(self, session_id, turn, error):
+        # The session stays where it was; peers are told the turn can be retried
+        logger.warning("Cannot %s in session %s: %r", turn, session_id, error)
+        session = self.sessions.get(session_id)
+        if session is None:
+            return
+        await self.send_to_peers(session, relay_messages.encode({
+            'type': 'turn_failed',
+            'turn': turn,
+            'current_page': session['current_page'],
+            'current_paragraph': session['current_paragraph'],
+            'retry': True
+        }))
 
-    async def handle_upload_chunk(self, websocket, device_id, session_id, title, chunk_index, chunk_data):
-        #print(f"handle_upload_chunk {device_id} {session_id} {title} {chunk_index}")
+    def open_upload(self, session_id):
+        # Continues from whatever an earlier connection already wrote to the partial file
+        session = self.sessions[session_id]
+        if session.get('upload') is None:
+            part_path = os.path.join(BASE_PDF_PATH, f"{session_id}.pdf{PARTIAL_UPLOAD_SUFFIX}")
+            fd = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+            session['upload'] = {
+                'path': part_path,
+                'fd': fd,
+                'received': os.fstat(fd).st_size,
+                'next_chunk': None,
+                'chunks': {}
+            }
+        return session['upload']
+
+    def close_upload(self, session):
+        upload = session.get('upload')
+        if upload is not None:
+            os.close(upload['fd'])
+            session['upload'] = None
+
+    def write_upload(self, upload, offset, data):
+        os.pwrite(upload['fd'], data, offset)
+        end = offset + len(data)
+        if end > upload['received']:
+            UPLOAD_BYTES.inc(end - upload['received'])
+            upload['received'] = end
+
+    async def send_upload_status(self, websocket, session_id, received, complete=False):
+        await websocket.send(relay_messages.encode({
+            'type': 'upload_status',
+            'session_id': session_id,
+            'offset': received,
+            'complete': complete
+        }))
+
+    async def handle_upload_start(self, websocket, device_id, session_id, title):
         if session_id not in self.sessions:
             await self.register(websocket, device_id, session_id, title)
-        session = self.sessions[session_id]
-        if session_id not in session['file_chunks']:
-            session['file_chunks'][session_id] = {}
-        session['file_chunks'][session_id][chunk_index] = chunk_data
+        upload = self.open_upload(session_id)
+        # The client sends binary frames from this offset on
+        await self.send_upload_status(websocket, session_id, upload['received'])
+
+    async def handle_upload_frame(self, websocket, frame):
+        try:
+            session_id, offset, data = relay_messages.decode_upload_frame(frame)
+        except (ValueError, UnicodeDecodeError) as e:
+            logger.warning("Discarding invalid upload frame: %s", e)
+            return
+        if session_id not in self.sessions:
+            logger.warning("Discarding upload frame for unknown session %s", session_id)
+            return
+        upload = self.open_upload(session_id)
+        # Data past a gap cannot be placed; the client is told where to resume
+        if offset > upload['received']:
+            await self.send_upload_status(websocket, session_id, upload['received'])
+            return
+        self.write_upload(upload, offset, data)
 
-    async def handle_upload_complete(self, websocket, device_id, session_id, title):
+    async def handle_upload_chunk(self, websocket, device_id, session_id, title, chunk_index, chunk_data):
+        # Base64 JSON chunks from older clients are appended in index order as soon as they follow on from chunk 0;
+        # others are held in memory until upload_complete
+        if session_id not in self.sessions:
+            await self.register(websocket, device_id, session_id, title)
+        upload = self.open_upload(session_id)
+        if upload['next_chunk'] is None:
+            # Chunked uploads cannot be resumed, so they always start a fresh file
+            os.ftruncate(upload['fd'], 0)
+            upload['received'] = 0
+            upload['next_chunk'] = 0
+        upload['chunks'][chunk_index] = chunk_data
+        while upload['next_chunk'] in upload['chunks']:
+            self.write_upload(upload, upload['received'], base64.b64decode(upload['chunks'].pop(upload['next_chunk'])))
+            upload['next_chunk'] += 1
+
+    async def handle_upload_complete(self, websocket, device_id, session_id, title, size=None):
         #print(f"handle_upload_complete {device_id} {session_id} {title}")
         session = self.sessions[session_id]
+        upload = self.open_upload(session_id)
+        # Chunks still held, numbered from 1 or after a gap, are appended in sorted index order as they always were
+        for chunk_index in sorted(upload['chunks']):
+            self.write_upload(upload, upload['received'], base64.b64decode(upload['chunks'].pop(chunk_index)))
+        if size is not None and upload['received'] != size:
+            logger.warning("Upload for session %s incomplete at %d bytes", session_id, upload['received'])
+            await self.send_upload_status(websocket, session_id, upload['received'])
+            return
+
         session['title'] = title
         session['lead_device_id'] = device_id
-        filename = f"{session_id}.pdf"
-        pdf_path = os.path.join(BASE_PDF_PATH, filename)
-
-        with open(pdf_path, 'wb') as f:
-            for i in sorted(session['file_chunks'][session_id].keys()):
-                f.write(base64.b64decode(session['file_chunks'][session_id][i]))
 
+        os.fsync(upload['fd'])
+        self.close_upload(session)
+        loop = asyncio.get_running_loop()
+        content_hash = await loop.run_in_executor(None, file_digest, upload['path'])
+        library_path = os.path.join(BASE_PDF_PATH, LIBRARY_DIR)
+        os.makedirs(library_path, exist_ok=True)
+        pdf_path = os.path.join(library_path, f"{content_hash}.pdf")
+
+        # A book uploaded before is read from the stored copy; otherwise readers only ever see the complete file
+        if os.path.exists(pdf_path):
+            LIBRARY_UPLOADS.labels("duplicate").inc()
+            os.remove(upload['path'])
+        else:
+            LIBRARY_UPLOADS.labels("new").inc()
+            os.replace(upload['path'], pdf_path)
+
+        # Content of the previous file is dropped; jobs still running on it fill the old dict only
+        previous_path = self.document_path(session_id)
+        previous_hash = session.get('content_hash')
+        self.cancel_content(session)
+        session['content'] = {}
+        session['content_hash'] = content_hash
         session['pdf_path'] = pdf_path
-        del session['file_chunks'][session_id]
-        print(f"File uploaded and saved to {pdf_path}")
+        if previous_path != pdf_path:
+            self.release_document(previous_path, previous_hash)
+        logger.info("File uploaded and saved to %s", pdf_path)
+        await self.send_upload_status(websocket, session_id, upload['received'], complete=True)
+
+        self.start_background(self.load_extraction(content_hash, pdf_path))
+        # The first pages are ready before anyone turns to them
+        self.start_background(self.prefetch_content(session_id))
+
+    def start_background(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    def document_path(self, session_id):
+        # Sessions without an upload read the file named after them
+        session = self.sessions.get(session_id)
+        if session is not None and session.get('pdf_path'):
+            return session['pdf_path']
+        return f"{BASE_PDF_PATH}/{session_id}.pdf"
+
+    def release_document(self, pdf_path, content_hash=None):
+        # Once no session reads the file, the handle opened inline and the unfinished extraction of the book go.
+        # Workers' handles are left to their smaller LRU (see start_pdf_worker); stored books never change under a path.
+        if any(self.document_path(session_id) == pdf_path for session_id in self.sessions):
+            return
+        pdf_documents.close(pdf_path)
+        build = self.extraction_builds.get(content_hash)
+        if build is not None:
+            build.cancel()
+
+    def cancel_content(self, session):
+        for job in session.get('content', {}).values():
+            job.cancel()
+
+    async def load_extraction(self, content_hash, pdf_path):
+        # Every page of a stored book is extracted once and kept on disk next to it, across sessions and restarts
+        if content_hash in self.extractions or content_hash in self.extraction_builds:
+            return
+        extraction_path = os.path.join(os.path.dirname(pdf_path), f"{content_hash}{EXTRACTION_SUFFIX}")
+        self.extraction_builds[content_hash] = asyncio.current_task()
+        try:
+            if not os.path.exists(extraction_path):
+                await self.write_extraction(pdf_path, extraction_path)
+            self.extractions[content_hash] = ExtractionStore(extraction_path)
+        except Exception as e:
+            logger.warning("Cannot store extracted content of %s: %s", pdf_path, e)
+        finally:
+            del self.extraction_builds[content_hash]
+
+    async def write_extraction(self, pdf_path, extraction_path):
+        page_count = await self.pdf_pool.run(pdf_page_count, pdf_path)
+        temporary_path = f"{extraction_path}.{os.getpid()}{PARTIAL_UPLOAD_SUFFIX}"
+        try:
+            with open(temporary_path, "wb") as f:
+                # Content follows the header and index, which are filled in once every offset is known
+                offset = EXTRACTION_HEADER.size + page_count * EXTRACTION_ENTRY.size
+                f.seek(offset)
+                index = []
+                for page_index in range(page_count):
+                    # One page per job, so pages other sessions are waiting for get their turn in between
+                    html, paragraphs = await self.pdf_pool.run(pdf_page_content, pdf_path, page_index)
+                    html = html.encode("utf-8")
+                    paragraphs = relay_messages.encoder.encode(paragraphs)
+                    f.write(html)
+                    f.write(paragraphs)
+                    index.append((offset, len(html), offset + len(html), len(paragraphs)))
+                    offset += len(html) + len(paragraphs)
+                f.seek(0)
+                f.write(EXTRACTION_HEADER.pack(EXTRACTION_MAGIC, page_count))
+                for entry in index:
+                    f.write(EXTRACTION_ENTRY.pack(*entry))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary_path, extraction_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def read_extraction(self, store, kind, key):
+        # Same numbering as the extraction methods: HTML pages from 1, paragraphs by page index
+        if kind == 'page_count':
+            return store.page_count
+        if kind == 'page':
+            return store.page_html(key - 1)
+        return store.paragraphs(key)
+
+    def content_job(self, session_id, kind, key=None):
+        # One extraction per item per session; every peer asking for it shares the same job
+        session = self.sessions[session_id]
+        content = session.setdefault('content', {})
+        job = content.get((kind, key))
+        if job is None:
+            loop = asyncio.get_running_loop()
+            store = self.extractions.get(session.get('content_hash'))
+            if store is not None:
+                # Already extracted: read straight from the stored pages without touching the PDF
+                job = loop.create_future()
+                try:
+                    job.set_result(self.read_extraction(store, kind, key))
+                except (IndexError, ValueError) as e:
+                    job.set_exception(e)
+            else:
+                pdf_path = self.document_path(session_id)
+                if kind == 'page_count':
+                    args = (pdf_page_count, pdf_path)
+                elif kind == 'page':
+                    args = (pdf_page_html, pdf_path, key)
+                else:
+                    args = (pdf_page_paragraphs, pdf_path, key)
+                job = asyncio.ensure_future(self.pdf_pool.run(*args))
+            content[(kind, key)] = job
+            job.add_done_callback(lambda job: self.discard_failed_job(content, kind, key, job))
+        return job
+
+    def discard_failed_job(self, content, kind, key, job):
+        # A failed, timed out or cancelled extraction is retried by the next request rather than cached
+        if (job.cancelled() or job.exception() is not None) and content.get((kind, key)) is job:
+            del content[(kind, key)]
+
+    async def get_content(self, session_id, kind, key=None):
+        while True:
+            job = self.content_job(session_id, kind, key)
+            CONTENT_CACHE.labels("ready" if job.done() else "waited").inc()
+            try:
+                # A waiter that is cancelled must not cancel the job for everyone else
+                return await asyncio.shield(job)
+            except asyncio.CancelledError:
+                # The job was cancelled for a new upload of the session's file; the waiter asks again
+                if not job.cancelled() or session_id not in self.sessions:
+                    raise
+
+    async def prefetch_content(self, session_id):
+        if session_id not in self.sessions:
+            return
+        try:
+            page_count = await self.get_content(session_id, 'page_count')
+        except Exception as e:
+            logger.warning("Cannot prefetch session %s: %s", session_id, e)
+            return
+        session = self.sessions.get(session_id)
+        if session is None:
+            return
+        current_page = session['current_page']
+        content = session['content']
+
+        # Pages are numbered from 1 for HTML and passed as is to extract_paragraphs
+        for page_number in range(max(current_page, 1), min(current_page + PREFETCH_PAGES, page_count) + 1):
+            self.content_job(session_id, 'page', page_number)
+        for page_number in range(current_page, min(current_page + PREFETCH_PAGES, page_count - 1) + 1):
+            self.content_job(session_id, 'paragraphs', page_number)
+
+        # Reading only moves forward, so pages left behind are dropped
+        for kind, key in list(content):
+            if key is not None and key < current_page - 1:
+                del content[(kind, key)]
 
     #on each page turn, generate the paragraphs and notify peers 
        
     async def notify_page_turn(self, session_id):
-        print(f"notify_page_turn {session_id}")
+        logger.debug("notify_page_turn %s", session_id)
         session = self.sessions[session_id]
-        page_count = self.page_count(session_id)
-
-        # Ensure the page number starts at 1, not 0
-        if session['current_page'] < page_count:
-            session['current_page'] += 1
-
-        current_page = session['current_page']
+        # The session only moves once the page has been extracted, so a failed or timed out job leaves it as it was
+        try:
+            page_count = await self.get_content(session_id, 'page_count')
+            # Ensure the page number starts at 1, not 0
+            current_page = session['current_page'] + 1 if session['current_page'] < page_count else session['current_page']
+            page = await self.get_content(session_id, 'page', current_page)
+        except Exception as e:
+            await self.notify_turn_failed(session_id, 'turn_page', e)
+            return
+        session['current_page'] = current_page
 
         message = {
             'type': 'turn_page',
@@ -112,39 +536,46 @@ class RelayServer:
             'page_count': page_count
         }
             
-        message['page'] = self.extract_page(session_id, current_page)
+        message['page'] = page
         message['page_count'] = page_count
-        message_json = json.dumps(message)
+        message_json = relay_messages.encode(message)
 
         #print(f"notify_paragraph_turn message= {message_json}")
-        print(f"notify_page_turn peers= {session['peers']}")
+        logger.debug("notify_page_turn peers= %s", session['peers'])
 
         # Send the update to all peers in the session
-        await asyncio.gather(*[peer['websocket'].send(message_json) for peer in session['peers'].values()])
+        await self.send_to_peers(session, message_json)
+        # Extraction of the pages that follow overlaps with reading this one
+        await self.prefetch_content(session_id)
         
     async def notify_paragraph_turn(self, session_id):
-        print(f"notify_paragraph_turn {session_id}")
+        logger.debug("notify_paragraph_turn %s", session_id)
         session = self.sessions[session_id]
         current_page = session['current_page']
         current_paragraph = session['current_paragraph']
 
-        # Check if it's a new page
-        if current_paragraph == 0:
-            paragraphs = self.extract_paragraphs(session_id, current_page)
-        else:
-            paragraphs = None
+        # As for page turns, the position is only written back once the paragraphs are in hand
+        try:
+            # Check if it's a new page
+            if current_paragraph == 0:
+                paragraphs = await self.get_content(session_id, 'paragraphs', current_page)
+            else:
+                paragraphs = None
 
-        if paragraphs is not None and current_paragraph < len(paragraphs) - 1:
-            session['current_paragraph'] += 1
-        else:
-            session['current_paragraph'] = 0
-            session['current_page'] += 1
-            # Extract paragraphs only if it's a new page
-            paragraphs = self.extract_paragraphs(session_id, session['current_page'])
+            if paragraphs is not None and current_paragraph < len(paragraphs) - 1:
+                current_paragraph += 1
+            else:
+                current_paragraph = 0
+                current_page += 1
+                # Extract paragraphs only if it's a new page
+                paragraphs = await self.get_content(session_id, 'paragraphs', current_page)
+        except Exception as e:
+            await self.notify_turn_failed(session_id, 'turn_paragraph', e)
+            return
 
         # Ensure the page number starts at 1, not 0
-        if session['current_page'] < 1:
-            session['current_page'] = 1
+        session['current_page'] = max(current_page, 1)
+        session['current_paragraph'] = current_paragraph
 
         message = {
             'type': 'turn_paragraph',
@@ -159,68 +590,25 @@ class RelayServer:
             message['paragraphs'] = ""
 
         # Convert the message to JSON
-        message_json = json.dumps(message)
+        message_json = relay_messages.encode(message)
 
         #print(f"notify_paragraph_turn message= {message_json}")
         #print(f"notify_paragraph_turn peers= {session['peers']}")
 
         # Send the update to all peers in the session
-        await asyncio.gather(*[peer['websocket'].send(message_json) for peer in session['peers'].values()])
+        await self.send_to_peers(session, message_json)
+        # Extraction of the pages that follow overlaps with reading this one
+        await self.prefetch_content(session_id)
 
+    # Direct extraction in this process; sessions go through content_job and the PDF pool
     def extract_page(self, session_id, page_number):
-        pdf_path = f"{BASE_PDF_PATH}/{session_id}.pdf"
-        doc = pymupdf.open(pdf_path)
-        page = doc.load_page(page_number - 1)  # Page numbers are zero-based
-        text_html = page.get_text("html")
-        doc.close()
-        return text_html
+        return pdf_page_html(self.document_path(session_id), page_number)
 
     def page_count(self, session_id):
-        pdf_path = f"{BASE_PDF_PATH}/{session_id}.pdf"
-        doc = pymupdf.open(pdf_path)
-        page_count = doc.page_count
-        doc.close()
-        return page_count
+        return pdf_page_count(self.document_path(session_id))
 
     def extract_paragraphs(self, session_id, page_number, spacing_threshold=10, font_size_threshold=14, header_y_threshold=100, min_paragraph_length=20):
-        pdf_path = f"{BASE_PDF_PATH}/{session_id}.pdf"
-        doc = pymupdf.open(pdf_path)
-        page = doc.load_page(page_number)
-        text_dict = page.get_text("dict")
-        blocks = text_dict['blocks']
-        
-        paragraphs = []
-        current_paragraph = []
-        previous_bottom = None
-
-        for block in blocks:
-            # Only process text blocks
-            if 'lines' not in block:
-                continue
-
-            for line in block['lines']:
-                for span in line['spans']:
-                    top = span['bbox'][1]
-                    bottom = span['bbox'][3]
-                    text = span['text']
-                    font_size = span['size']
-
-                    # Exclude blocks that are likely headers based on font size, position, and length
-                    if (font_size > font_size_threshold and top < header_y_threshold) or len(text.strip()) < min_paragraph_length:
-                        continue
-
-                    if previous_bottom is not None and (top - previous_bottom) > spacing_threshold:
-                        if len(" ".join(current_paragraph).strip()) >= min_paragraph_length:
-                            paragraphs.append(" ".join(current_paragraph).strip())
-                        current_paragraph = []
-
-                    current_paragraph.append(text)
-                    previous_bottom = bottom
-
-        if current_paragraph and len(" ".join(current_paragraph).strip()) >= min_paragraph_length:
-            paragraphs.append(" ".join(current_paragraph).strip())
-
-        return paragraphs
+        return pdf_page_paragraphs(self.document_path(session_id), page_number, spacing_threshold, font_size_threshold, header_y_threshold, min_paragraph_length)
 
     def populate_sample_data(self):
         # Add 20 sample sessions
@@ -240,45 +628,73 @@ class RelayServer:
             for session_id, info in self.sessions.items()
         ]
 
-        message = json.dumps({
+        message = relay_messages.encode({
             'type': 'list_sessions_response',
             'sessions': sessions
         })
 
-        print(f"list_sessions - {sessions}")
+        logger.debug("list_sessions - %s", sessions)
         
         await websocket.send(message)            
 
 relay_server = RelayServer()
 
-async def handle_connection(websocket, path): #TODO extract data into variables to pass to functions
+async def handle_register(websocket, message):
+    logger.debug("handle_connection - register %s %s", message.device_id, message.session_id)
+    await relay_server.register(websocket, message.device_id, message.session_id, message.title)
+
+async def handle_unregister(websocket, message):
+    logger.debug("handle_connection - unregister")
+    await relay_server.unregister(websocket)
+
+async def handle_ready(websocket, message):
+    logger.debug("handle_connection - handle_ready %s %s %s", message.device_id, message.session_id, message.ready)
+    await relay_server.handle_ready(websocket, message.device_id, message.session_id, message.ready)
+
+async def handle_upload_chunk(websocket, message):
+    await relay_server.handle_upload_chunk(websocket, message.device_id, message.session_id, message.title, message.chunk_index, message.chunk_data)
+
+async def handle_upload_start(websocket, message):
+    await relay_server.handle_upload_start(websocket, message.device_id, message.session_id, message.title)
+
+async def handle_upload_complete(websocket, message):
+    await relay_server.handle_upload_complete(websocket, message.device_id, message.session_id, message.title, message.size)
+
+async def handle_list_sessions(websocket, message):
+    await relay_server.list_sessions(websocket)
+
+MESSAGE_HANDLERS = {
+    CoreaderRegister: handle_register,
+    CoreaderUnregister: handle_unregister,
+    Ready: handle_ready,
+    UploadChunk: handle_upload_chunk,
+    UploadStart: handle_upload_start,
+    UploadComplete: handle_upload_complete,
+    ListSessions: handle_list_sessions,
+}
+
+async def handle_connection(websocket, path):
+    CONNECTIONS.inc()
     try:
-        async for message in websocket:
-            #print(f"handle_connection - {message}")
-            data = json.loads(message)
-            if data["type"] == "register":
-                print(f"handle_connection - register {data['device_id']} {data['session_id']}")
-                await relay_server.register(websocket, data["device_id"], data["session_id"], data["title"])
-            elif data["type"] == "unregister":
-                print(f"handle_connection - unregister")
-                await relay_server.unregister(websocket)                
-            elif data["type"] == "ready":
-                print(f"handle_connection - handle_ready {data['device_id']} {data['session_id']} {data['ready']}")
-                await relay_server.handle_ready(websocket, data['device_id'], data['session_id'], data['ready'])
-            elif data["type"] == "upload_chunk":
-                #print(f"handle_connection - upload_chunk {data['device_id']} {data['session_id']} {data['title']} {data['chunk_index']}")
-                await relay_server.handle_upload_chunk(websocket, data['device_id'], data['session_id'], data['title'], data['chunk_index'], data['chunk_data'])
-            elif data["type"] == "upload_complete":
-                #print(f"handle_connection - upload_complete {data['device_id']} {data['session_id']} {data['title']}")
-                await relay_server.handle_upload_complete(websocket, data['device_id'], data['session_id'], data['title'])
-            elif data["type"] == "list_sessions":
-                #print(f"handle_connection - list_sessions")
-                await relay_server.list_sessions(websocket)
-                
+        async for frame in websocket:
+            # Binary frames carry upload data as is
+            if isinstance(frame, bytes):
+                MESSAGES.labels("upload_data").inc()
+                await relay_server.handle_upload_frame(websocket, frame)
+                continue
+            await relay_messages.dispatch(websocket, frame, relay_messages.coreader_decoder, MESSAGE_HANDLERS, MESSAGES, logger)
+
     except websockets.exceptions.ConnectionClosedError:
         pass
+    finally:
+        CONNECTIONS.dec()
+        # A dropped socket leaves its session like an unregister frame, ending the session with its last peer
+        await relay_server.unregister(websocket)
 
 async def main():
+    configure_logging(os.environ.get("COREADER_LOG_LEVEL", "INFO"))
+    start_metrics_server(int(os.environ.get("COREADER_METRICS_PORT", METRICS_PORT)))
+
     key_file_path = "/home/niyid/workspace/coreader.key"
     crt_file_path = "/home/niyid/workspace/coreader.crt"
 
@@ -292,18 +708,20 @@ async def main():
 
         ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         ssl_context.load_cert_chain(crt_file_path, keyfile=key_file_path, password="")
-        print("Certificate and key loaded successfully from:", key_file_path)
+        logger.info("Certificate and key loaded successfully from: %s", key_file_path)
 
     except FileNotFoundError:
-        print("Error: File not found at path:", key_file_path)
+        logger.error("Error: File not found at path: %s", key_file_path)
     except Exception as e:
-        print("An error occurred:", e)
+        logger.error("An error occurred: %s", e)
     
     async with websockets.serve(handle_connection, "0.0.0.0", 8765, ssl=ssl_context):
-        print(f"Server running on port 8765")
+        logger.info("Server running on port 8765")
         while True:
-            print(f"Daemons run here...")
+            logger.debug("Daemons run here...")
             await asyncio.sleep(2 * 24 * 3600)
 
-asyncio.run(main())
+# PDF worker processes import this module, so the server only starts when it is run directly
+if __name__ == "__main__":
+    asyncio.run(main())
 
@@ -0,0 +1,54 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+class WorkerPool:
+    # CPU-bound jobs for a relay, run in worker processes so the event loop keeps serving sockets.
+    # Functions and their arguments must be picklable; with no workers they run inline instead.
+    def __init__(self, max_workers, seconds, queue_limit=None, timeout=None, timeouts=None, initializer=None):
+        self.max_workers = max_workers
+        # Called in each worker process with the number of workers before it takes any job
+        self.initializer = initializer
+        # Histogram of job time including the wait for a worker, labelled by function name
+        self.seconds = seconds
+        # At most queue_limit jobs are submitted at once; further callers wait for a slot
+        self.slots = asyncio.Semaphore(queue_limit) if queue_limit else None
+        # Past the timeout a caller gives up, counted in timeouts; the job still runs to the end in its worker
+        self.timeout = timeout
+        self.timeouts = timeouts
+        self.executor = None
+
+    def start(self, max_workers=None):
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if self.max_workers > 0 and self.executor is None:
+            # Fresh interpreters rather than forks of a process with a running event loop and open sockets
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=self.initializer, initargs=(self.max_workers,) if self.initializer else ())
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, function, *args):
+        with self.seconds.labels(function.__name__).time():
+            if self.slots is None:
+                return await self.submit(function, *args)
+            async with self.slots:
+                return await self.submit(function, *args)
+
+    async def submit(self, function, *args):
+        if self.max_workers <= 0:
+            return function(*args)
+        self.start()
+        job = asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        if self.timeout is None:
+            return await job
+        try:
+            return await asyncio.wait_for(job, self.timeout)
+        except asyncio.TimeoutError:
+            if self.timeouts is not None:
+                self.timeouts.labels(function.__name__).inc()
+            raise
@@ -0,0 +1,67 @@
+import unittest
+import json
+import fakeredis
+from relay_server_buzzr6 import GeoHashTree, GEOHASH_INDEX_KEY
+
+class TestMoveUser(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # MOVE_MEMBER_SCRIPT runs as Lua inside the fake server, as it would in Redis
+        self.redis_conn = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+        self.geo_tree = GeoHashTree(self.redis_conn)
+
+    async def asyncTearDown(self):
+        await self.redis_conn.aclose()
+
+    async def user_record(self, device_id):
+        return json.loads(await self.redis_conn.get(f"user:{device_id}"))
+
+    async def cell_members(self, cell):
+        return {member.decode("utf-8") for member in await self.redis_conn.smembers(f"geohash_users:{cell}")}
+
+    async def indexed_cells(self):
+        return {cell.decode("utf-8") for cell in await self.redis_conn.zrange(GEOHASH_INDEX_KEY, 0, -1)}
+
+    async def test_first_move_places_device(self):
+        self.assertTrue(await self.geo_tree.move_user("d1", "s14kuzm1"))
+        self.assertEqual((await self.user_record("d1"))['cell'], "s14kuzm")
+        self.assertEqual(await self.cell_members("s14kuzm"), {"d1"})
+        self.assertEqual(await self.indexed_cells(), {"s14kuzm"})
+
+    async def test_move_within_cell_is_noop(self):
+        await self.geo_tree.move_user("d1", "s14kuzm1")
+        self.assertFalse(await self.geo_tree.move_user("d1", "s14kuzm2"))
+        # Nothing is written, so the record keeps the first geohash
+        self.assertEqual((await self.user_record("d1"))['geohash'], "s14kuzm1")
+
+    async def test_forced_move_within_cell_rewrites_record(self):
+        await self.geo_tree.move_user("d1", "s14kuzm1")
+        self.assertTrue(await self.geo_tree.move_user("d1", "s14kuzm2", force=True))
+        self.assertEqual((await self.user_record("d1"))['geohash'], "s14kuzm2")
+        self.assertEqual(await self.cell_members("s14kuzm"), {"d1"})
+
+    async def test_move_to_new_cell_empties_old_cell(self):
+        await self.geo_tree.move_user("d1", "s14kuzm1")
+        self.assertTrue(await self.geo_tree.move_user("d1", "s14kuzq1"))
+        self.assertEqual(await self.cell_members("s14kuzm"), set())
+        self.assertEqual(await self.cell_members("s14kuzq"), {"d1"})
+        self.assertEqual(await self.indexed_cells(), {"s14kuzq"})
+
+    async def test_move_keeps_old_cell_with_other_devices(self):
+        await self.geo_tree.move_user("d1", "s14kuzm1")
+        await self.geo_tree.move_user("d2", "s14kuzm2")
+        await self.geo_tree.move_user("d1", "s14kuzq1")
+        self.assertEqual(await self.cell_members("s14kuzm"), {"d2"})
+        self.assertEqual(await self.indexed_cells(), {"s14kuzm", "s14kuzq"})
+
+    async def test_old_record_with_full_geohash(self):
+        # Records written before cells were truncated name the cell by the device's full geohash
+        await self.redis_conn.set("user:d1", json.dumps({'device_id': "d1", 'geohash': "s14kuzm1"}))
+        await self.redis_conn.sadd("geohash_users:s14kuzm1", "d1")
+        await self.redis_conn.geoadd(GEOHASH_INDEX_KEY, (3.3792, 6.5244, "s14kuzm1"))
+        self.assertTrue(await self.geo_tree.move_user("d1", "s14kuzm1"))
+        self.assertEqual(await self.cell_members("s14kuzm1"), set())
+        self.assertEqual(await self.cell_members("s14kuzm"), {"d1"})
+        self.assertEqual(await self.indexed_cells(), {"s14kuzm"})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import os
+import tempfile
+import pymupdf
+from pdf_paragraphs import page_html_and_paragraphs
+from relay_messages import decode_upload_frame, encode_upload_frame
+from relay_server_coreader import RelayServer, ExtractionStore
+
+TEST_PDF_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test.pdf")
+
+class TestUploadFrames(unittest.TestCase):
+    def test_round_trip(self):
+        frame = encode_upload_frame("session-1", 1 << 40, b"%PDF-1.7 data")
+        session_id, offset, data = decode_upload_frame(frame)
+        self.assertEqual(session_id, "session-1")
+        self.assertEqual(offset, 1 << 40)
+        self.assertEqual(bytes(data), b"%PDF-1.7 data")
+
+    def test_round_trip_non_ascii_session(self):
+        session_id, offset, data = decode_upload_frame(encode_upload_frame("séance", 0, b""))
+        self.assertEqual(session_id, "séance")
+        self.assertEqual(offset, 0)
+        self.assertEqual(bytes(data), b"")
+
+    def test_data_is_a_view_of_the_frame(self):
+        frame = bytearray(encode_upload_frame("s", 0, b"abc"))
+        _, _, data = decode_upload_frame(frame)
+        self.assertIsInstance(data, memoryview)
+        frame[-1:] = b"z"
+        self.assertEqual(bytes(data), b"abz")
+
+    def test_short_frames(self):
+        frame = encode_upload_frame("session-1", 0, b"")
+        for length in (0, 1, 5, len(frame) - 1):
+            with self.subTest(length=length):
+                with self.assertRaises(ValueError):
+                    decode_upload_frame(frame[:length])
+
+class TestExtractionStore(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.extraction_path = os.path.join(self.directory.name, "test.pages")
+        # PDF jobs run inline rather than in worker processes
+        relay_server = RelayServer()
+        relay_server.pdf_pool.start(0)
+        await relay_server.write_extraction(TEST_PDF_PATH, self.extraction_path)
+        self.store = ExtractionStore(self.extraction_path)
+
+    async def asyncTearDown(self):
+        self.store.mmap.close()
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        with pymupdf.open(TEST_PDF_PATH) as doc:
+            expected = [page_html_and_paragraphs(page) for page in doc]
+        self.assertEqual(self.store.page_count, len(expected))
+        for page_index, (html, paragraphs) in enumerate(expected):
+            with self.subTest(page_index=page_index):
+                self.assertEqual(self.store.page_html(page_index), html)
+                self.assertEqual(self.store.paragraphs(page_index), paragraphs)
+
+    def test_pages_outside_document(self):
+        for page_index in (-1, self.store.page_count):
+            with self.subTest(page_index=page_index):
+                with self.assertRaises(IndexError):
+                    self.store.page_html(page_index)
+                with self.assertRaises(IndexError):
+                    self.store.paragraphs(page_index)
+
+    def test_rejects_other_files(self):
+        with self.assertRaises(ValueError):
+            ExtractionStore(TEST_PDF_PATH)
+
+if __name__ == '__main__':
+    unittest.main()